@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Native bulk inserts of the destination dialects.
+
+Like the INSERT statements compiled in ``compiler.py``, the rows which
+already exist in the destination table are skipped.
+"""
+
+import datetime
+import json
+import os
+import tempfile
+from functools import lru_cache
+from io import StringIO
+
+from sqlalchemy.sql import column, select
+from sqlalchemy.sql import table as table_clause
+
+__all__ = ["bulk_insert", "dump_csv", "dump_mysql_infile"]
+
+BULK_INSERTS = {}
+
+MYSQL_ESCAPES = [
+    (b"\\", b"\\\\"),
+    (b"\t", b"\\t"),
+    (b"\n", b"\\n"),
+    (b"\r", b"\\r"),
+    (b"\0", b"\\0"),
+]
+
+
+def bulk_inserts(dialect):
+    """Registers the decorated function as the bulk insert of ``dialect``."""
+
+    def decorator(func):
+        BULK_INSERTS[dialect] = func
+        return func
+
+    return decorator
+
+
+def bulk_insert(connection, table, rows):
+    """Inserts ``rows`` (dicts of column values) into ``table`` with the native
+    bulk insert of the connection dialect, or an executemany INSERT."""
+    insert = BULK_INSERTS.get(connection.dialect.name, executemany_insert)
+    insert(connection, table, rows)
+
+
+def executemany_insert(connection, table, rows):
+    connection.execute(table.insert(), rows)
+
+
+@bulk_inserts("sqlite")
+def bulk_insert_sqlite(connection, table, rows):
+    # A prepared statement run by the DBAPI executemany, with positional
+    # parameters and without the SQLAlchemy statement compilation per row
+    dialect = connection.dialect
+    columns = list(table.columns)
+    statement = table.insert().compile(
+        dialect=dialect, column_keys=[c.key for c in columns]
+    )
+    processors = get_bind_processors(dialect, table)
+    params = [
+        tuple(
+            value if processor is None or value is None else processor(value)
+            for value, processor in zip((row[c.name] for c in columns), processors)
+        )
+        for row in rows
+    ]
+    connection.execute(str(statement), params)
+
+
+@lru_cache(maxsize=128)
+def get_bind_processors(dialect, table):
+    """Returns the bind processors of the columns of ``table``, created once
+    per dialect and table."""
+    # The dialect implementation of the types, such as the DATETIME of SQLite,
+    # processes the values which the generic types leave to the DBAPI
+    return [c.type.dialect_impl(dialect).bind_processor(dialect) for c in table.columns]
+
+
+@bulk_inserts("postgresql")
+def bulk_insert_postgresql(connection, table, rows):
+    # COPY does not skip the existing rows, the rows are copied into a
+    # temporary table and then inserted with "ON CONFLICT DO NOTHING"
+    preparer = connection.dialect.identifier_preparer
+    names = [c.name for c in table.columns]
+    temp_name = "dbcut_%s" % table.name
+    connection.execute(
+        "CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP"
+        % (preparer.quote(temp_name), preparer.format_table(table))
+    )
+    buffer = StringIO()
+    dump_csv(rows, names, buffer)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        "COPY %s (%s) FROM STDIN WITH (FORMAT csv)"
+        % (preparer.quote(temp_name), ", ".join(preparer.quote(n) for n in names)),
+        buffer,
+    )
+    temp_table = table_clause(temp_name, *[column(n) for n in names])
+    connection.execute(table.insert().from_select(names, select(list(temp_table.c))))
+    connection.execute("DROP TABLE %s" % preparer.quote(temp_name))
+
+
+@bulk_inserts("mysql")
+def bulk_insert_mysql(connection, table, rows):
+    # LOAD DATA LOCAL INFILE has to be allowed by the client, with the
+    # "local_infile=1" parameter of the destination URI
+    if not connection.engine.url.query.get("local_infile"):
+        return executemany_insert(connection, table, rows)
+
+    preparer = connection.dialect.identifier_preparer
+    names = [c.name for c in table.columns]
+    fd, path = tempfile.mkstemp(suffix=".tsv")
+    try:
+        with os.fdopen(fd, "wb") as infile:
+            dump_mysql_infile(rows, names, infile)
+        connection.execute(
+            "LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s"
+            " CHARACTER SET utf8mb4 (%s)"
+            % (
+                preparer.format_table(table),
+                ", ".join(preparer.quote(n) for n in names),
+            ),
+            (path,),
+        )
+    finally:
+        os.remove(path)
+
+
+def dump_csv(rows, names, stream):
+    """Writes ``rows`` in the CSV format of the PostgreSQL COPY command: NULL
+    is an unquoted empty value, all the other values are quoted."""
+    for row in rows:
+        values = []
+        for name in names:
+            value = row[name]
+            if value is None:
+                values.append("")
+            else:
+                value = str(to_text(value, "\\x"))
+                values.append('"%s"' % value.replace('"', '""'))
+        stream.write(",".join(values) + "\n")
+
+
+def dump_mysql_infile(rows, names, stream):
+    """Writes ``rows`` in the default format of the MySQL LOAD DATA statement:
+    tab separated values escaped by backslashes, NULL written as ``\\N``."""
+    for row in rows:
+        values = []
+        for name in names:
+            value = row[name]
+            if value is None:
+                values.append(b"\\N")
+                continue
+            value = to_text(value)
+            if not isinstance(value, bytes):
+                value = str(value).encode("utf-8")
+            for char, escaped in MYSQL_ESCAPES:
+                value = value.replace(char, escaped)
+            values.append(value)
+        stream.write(b"\t".join(values) + b"\n")
+
+
+def to_text(value, bytes_prefix=None):
+    """Converts the values without a textual representation understood by the
+    bulk loads of the destination databases."""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        if bytes_prefix is not None:
+            return bytes_prefix + bytes(value).hex()
+        return bytes(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    return value
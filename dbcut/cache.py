@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+"""Row-oriented format of the query cache files.
+
+A cache file starts with a header (magic bytes, format version and codec), is
+followed by length-prefixed compressed chunks, an empty chunk and the CRC32 of
+all the previous bytes. Each chunk holds the plain row tuples of the tables
+reached from a batch of query objects, the rows of the queried table first,
+so that cached rows are inserted without rebuilding the ORM objects.
+
+``FORMAT_VERSION`` is bumped only when this layout changes. The files of the
+previous versions are still read, and rewritten in the current format on first
+use:
+
+1. chunks up to the end of the file, without checksum
+2. empty chunk and CRC32 footer
+"""
+
+import lzma
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import inspect
+from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_dict, set_committed_value
+
+from .exceptions import CorruptedCacheError
+from .loaders import extract_rows
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+__all__ = [
+    "CacheChunk",
+    "CacheLock",
+    "CacheManifest",
+    "CacheReader",
+    "CacheWriter",
+    "LegacyCacheReader",
+    "is_rows_cache",
+    "open_cache_file",
+]
+
+MAGIC = b"\x93DBCUT-ROWS"
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct(">%dsBB" % len(MAGIC))
+CHUNK_LENGTH = struct.Struct(">I")
+FOOTER = struct.Struct(">I")
+
+CACHE_EXTENSIONS = (".cache", ".count")
+
+# name: (identifier written in the header, compress, decompress)
+CACHE_CODECS = OrderedDict(
+    [
+        ("none", (0, bytes, bytes)),
+        ("zlib", (1, zlib.compress, zlib.decompress)),
+        ("lzma", (2, lzma.compress, lzma.decompress)),
+    ]
+)
+
+
+class CacheChunk(object):
+    """The rows of a batch of ``count`` query objects, as a list of
+    ``(table name, column names, row tuples, links)``. The links record the
+    loaded relationships, as ``{key: [(row index, target row indexes)]}``.
+    """
+
+    __slots__ = ("count", "tables")
+
+    def __init__(self, count, tables):
+        self.count = count
+        self.tables = tables
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def from_objects(cls, objects, columns_by_table):
+        objects = list(objects)
+        states_by_table = {}
+        rows_by_table = extract_rows(objects, states_by_table=states_by_table)
+        positions = {}
+        for states in states_by_table.values():
+            for index, state in enumerate(states):
+                positions[state] = index
+
+        tables = []
+        for table_name, rows in rows_by_table.items():
+            columns = columns_by_table[table_name]
+            rows = [tuple(row[c] for c in columns) for row in rows]
+            links = get_links(states_by_table[table_name], positions)
+            tables.append((table_name, columns, rows, links))
+        return cls(len(objects), tables)
+
+    def rows_by_table(self):
+        """Returns the rows grouped by table name, as dicts of column values."""
+        return {
+            table_name: [dict(zip(columns, row)) for row in rows]
+            for table_name, columns, rows, links in self.tables
+        }
+
+    def to_objects(self, db):
+        """Rebuilds the transient objects of the queried table, with their
+        loaded relationships."""
+        models = {model.__table__.name: model for model in db.models.values()}
+        instances_by_table = OrderedDict()
+        for table_name, columns, rows, links in self.tables:
+            mapper = class_mapper(models[table_name])
+            keys = [
+                mapper.get_property_by_column(mapper.local_table.c[c]).key
+                for c in columns
+            ]
+            instances = []
+            for row in rows:
+                instance = mapper.class_manager.new_instance()
+                instance_dict(instance).update(zip(keys, row))
+                instances.append(instance)
+            instances_by_table[table_name] = instances
+
+        for table_name, columns, rows, links in self.tables:
+            instances = instances_by_table[table_name]
+            mapper = class_mapper(models[table_name])
+            for key, targets in links.items():
+                relationship = mapper.relationships[key]
+                target_instances = instances_by_table.get(
+                    relationship.mapper.local_table.name, []
+                )
+                for index, target in targets:
+                    if relationship.uselist:
+                        value = [target_instances[i] for i in target]
+                    else:
+                        value = None if target is None else target_instances[target]
+                    set_committed_value(instances[index], key, value)
+
+        if not instances_by_table:
+            return []
+        return next(iter(instances_by_table.values()))[: self.count]
+
+
+def get_links(states, positions):
+    """Returns the loaded relationships of the instance ``states``, with the
+    related instances given by their row index."""
+    links = {}
+    for index, state in enumerate(states):
+        for relationship in state.mapper.relationships:
+            if relationship.key not in state.dict:
+                continue
+            value = state.dict[relationship.key]
+            if relationship.uselist:
+                target = [positions[inspect(v)] for v in value]
+            else:
+                target = None if value is None else positions[inspect(value)]
+            links.setdefault(relationship.key, []).append((index, target))
+    return links
+
+
+def get_columns_by_table(db):
+    """Returns the cached column names of each table, in the order of the
+    model ``_table_info``."""
+    columns_by_table = {}
+    for model in db.models.values():
+        table = model.__table__
+        columns_by_table[table.name] = [
+            table.c[key].name for key in model._table_info["columns"]
+        ]
+    return columns_by_table
+
+
+def is_rows_cache(fd):
+    """Tells if the cache file is in the row format, and not a legacy pickle
+    of ORM objects."""
+    position = fd.tell()
+    magic = fd.read(len(MAGIC))
+    fd.seek(position)
+    return magic == MAGIC
+
+
+class CacheWriter(object):
+    """Writes chunks of query objects to a cache file, followed by a CRC32
+    footer once closed."""
+
+    def __init__(self, fd, db, codec="zlib"):
+        self.fd = fd
+        self.db = db
+        self.codec_id, self.compress, _ = CACHE_CODECS[codec]
+        self._columns_by_table = get_columns_by_table(db)
+        self._checksum = 0
+        self._write(HEADER.pack(MAGIC, FORMAT_VERSION, self.codec_id))
+
+    def _write(self, data):
+        self._checksum = zlib.crc32(data, self._checksum)
+        self.fd.write(data)
+
+    def write(self, objects):
+        chunk = CacheChunk.from_objects(objects, self._columns_by_table)
+        return self.write_chunk(chunk)
+
+    def write_chunk(self, chunk):
+        payload = self.compress(
+            pickle.dumps((chunk.count, chunk.tables), pickle.HIGHEST_PROTOCOL)
+        )
+        self._write(CHUNK_LENGTH.pack(len(payload)))
+        self._write(payload)
+        return chunk.count
+
+    def close(self):
+        """Writes the end of the chunks and the checksum footer."""
+        self._write(CHUNK_LENGTH.pack(0))
+        self.fd.write(FOOTER.pack(self._checksum))
+
+
+class CacheReader(object):
+    """Reads the chunks of a cache file in the row format."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        try:
+            magic, version, codec_id = HEADER.unpack(fd.read(HEADER.size))
+        except struct.error:
+            raise CorruptedCacheError("Truncated cache file header")
+        if magic != MAGIC or not 1 <= version <= FORMAT_VERSION:
+            raise CorruptedCacheError("Unsupported cache file format")
+        self.version = version
+        for name, (identifier, compress, decompress) in CACHE_CODECS.items():
+            if identifier == codec_id:
+                self.codec = name
+                self.decompress = decompress
+                break
+        else:
+            raise CorruptedCacheError("Unknown cache codec %d" % codec_id)
+
+    @property
+    def is_outdated(self):
+        """Whether the file is written in a previous format version."""
+        return self.version < FORMAT_VERSION
+
+    def verify(self):
+        """Checks the footer checksum of the whole cache file."""
+        if self.version < 2:
+            # No checksum before the version 2
+            return
+        self.fd.seek(0, os.SEEK_END)
+        size = self.fd.tell() - FOOTER.size
+        if size < HEADER.size + CHUNK_LENGTH.size:
+            raise CorruptedCacheError("Truncated cache file")
+        self.fd.seek(0)
+        checksum = 0
+        remaining = size
+        while remaining:
+            data = self.fd.read(min(remaining, 1024 * 1024))
+            checksum = zlib.crc32(data, checksum)
+            remaining -= len(data)
+        (expected,) = FOOTER.unpack(self.fd.read(FOOTER.size))
+        if checksum != expected:
+            raise CorruptedCacheError("Cache file checksum mismatch")
+        self.fd.seek(HEADER.size)
+
+    def __iter__(self):
+        while True:
+            length = self.fd.read(CHUNK_LENGTH.size)
+            if not length and self.version < 2:
+                break
+            if len(length) < CHUNK_LENGTH.size:
+                raise CorruptedCacheError("Truncated cache file")
+            (length,) = CHUNK_LENGTH.unpack(length)
+            if not length:
+                break
+            payload = self.fd.read(length)
+            if len(payload) < length:
+                raise CorruptedCacheError("Truncated cache file")
+            count, tables = pickle.loads(self.decompress(payload))
+            yield CacheChunk(count, tables)
+
+
+class LegacyCacheReader(object):
+    """Reads the lists of objects of a cache file in the legacy format, a
+    sequence of pickles of ORM objects."""
+
+    def __init__(self, fd, metadata, session):
+        self.fd = fd
+        self.metadata = metadata
+        self.session = session
+
+    def __iter__(self):
+        while True:
+            try:
+                unpickler = sa_serializer.Deserializer(
+                    self.fd, self.metadata, self.session
+                )
+                yield unpickler.load()
+            except EOFError:
+                break
+
+
+class CacheManifest(object):
+    """Index of the cache entries, kept in a SQLite file at the root of the
+    cache directory: the size, creation time, last access and number of hits
+    of each cache key.
+    """
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, "manifest.db")
+        with self.connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT,"
+                " basename TEXT,"
+                " size INTEGER,"
+                " created REAL,"
+                " last_access REAL,"
+                " hits INTEGER DEFAULT 0)"
+            )
+
+    @contextmanager
+    def connect(self):
+        # A short transaction per operation, the manifest may be shared by
+        # several processes
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield con
+            con.commit()
+        finally:
+            con.close()
+
+    def add(self, key, model, basename):
+        """Records a new cache entry, replacing the previous one of the key."""
+        now = time.time()
+        with self.connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, 0)",
+                (key, model, basename, get_entry_size(basename), now, now),
+            )
+
+    def hit(self, key, model, basename):
+        """Records an access to the cache entry, created when the cache file
+        was written before the manifest."""
+        with self.connect() as con:
+            updated = con.execute(
+                "UPDATE entries SET hits = hits + 1, last_access = ? WHERE key = ?",
+                (time.time(), key),
+            ).rowcount
+        if not updated:
+            self.add(key, model, basename)
+            self.hit(key, model, basename)
+
+    def remove(self, key):
+        with self.connect() as con:
+            con.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.connect() as con:
+            con.execute("DELETE FROM entries")
+
+    def entries(self):
+        """Returns the cache entries, the least recently used first."""
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            return con.execute("SELECT * FROM entries ORDER BY last_access").fetchall()
+
+    def total_size(self):
+        with self.connect() as con:
+            (total_size,) = con.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return total_size
+
+    def evict(self, max_size, keep=()):
+        """Removes the least recently used entries until the cache size is
+        below ``max_size`` bytes, and returns them. The ``keep`` keys are never
+        evicted."""
+        evicted = []
+        total_size = self.total_size()
+        for entry in self.entries():
+            if total_size <= max_size:
+                break
+            if entry["key"] in keep:
+                continue
+            for extension in CACHE_EXTENSIONS:
+                path = entry["basename"] + extension
+                if os.path.exists(path):
+                    os.remove(path)
+            self.remove(entry["key"])
+            total_size -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+
+class CacheLock(object):
+    """Advisory lock of a cache entry, shared between the processes using
+    the same cache directory (a no-op without ``fcntl``).
+
+    The threads of a process share the lock of an entry, which is held by the
+    process until all of them release it: the queries fetched by concurrent
+    workers never wait for each other.
+    """
+
+    _file_locks = {}
+    _file_locks_mutex = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._acquired = False
+
+    def _file_lock(self):
+        with self._file_locks_mutex:
+            if self.path not in self._file_locks:
+                self._file_locks[self.path] = _FileLock(self.path)
+            return self._file_locks[self.path]
+
+    def acquire(self):
+        if not self._acquired:
+            self._file_lock().acquire()
+            self._acquired = True
+
+    def release(self):
+        if self._acquired:
+            self._file_lock().release()
+            self._acquired = False
+
+
+class _FileLock(object):
+    """Lock of a file held by the process as long as one of its threads
+    holds it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mutex = threading.Lock()
+        self._holders = 0
+        self._fd = None
+
+    def acquire(self):
+        with self._mutex:
+            if self._holders == 0:
+                self._fd = open(self.path, "a")
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._holders += 1
+
+    def release(self):
+        with self._mutex:
+            self._holders -= 1
+            if self._holders == 0:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self._fd.close()
+                self._fd = None
+
+
+def open_cache_file(path):
+    """Opens the cache file, memory-mapped when possible."""
+    with open(path, "rb") as fd:
+        try:
+            return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and file systems without mmap support
+            pass
+    return open(path, "rb")
+
+
+def get_entry_size(basename):
+    size = 0
+    for extension in CACHE_EXTENSIONS:
+        path = basename + extension
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
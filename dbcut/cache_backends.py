@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""Storage backends of the query cache.
+
+A cache entry is the content of a cache file (see ``dbcut.cache``) and a small
+``info`` dictionary (the number of cached objects), stored under a name made
+of the database namespace, the model and the cache key of the query::
+
+    postgresql/localhost/prod/album-8c2d...1f
+
+The backend is chosen by the ``cache`` configuration key: a directory path, or
+a ``sqlite:///``, ``memory://`` or ``http(s)://`` URL.
+"""
+
+import glob
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .cache import CacheLock, CacheManifest, open_cache_file
+from .serializer import dump_json, load_json
+from .utils import atomic_path, create_directory
+
+__all__ = [
+    "CacheBackend",
+    "DirectoryCacheBackend",
+    "SqliteCacheBackend",
+    "MemoryCacheBackend",
+    "HttpCacheBackend",
+    "get_cache_backend",
+    "is_cache_url",
+]
+
+ENTRY_NAME_RE = re.compile(r"(?P<model>[^/]+)-(?P<key>[0-9a-f]{40})$")
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_entry_name(name):
+    """Returns the model and the cache key of an entry name."""
+    match = ENTRY_NAME_RE.search(name)
+    if match is None:
+        return None, name
+    return match.group("model"), match.group("key")
+
+
+class NullLock(object):
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class CacheBackend(object):
+    """Interface of the cache backends.
+
+    The entries returned by ``stats`` and ``evict`` are dictionaries with the
+    ``name``, ``key``, ``model``, ``size``, ``created``, ``last_access`` and
+    ``hits`` of each entry.
+    """
+
+    def exists(self, name):
+        return self.info(name) is not None
+
+    def info(self, name):
+        """Returns the info dictionary of the entry, None when missing."""
+        raise NotImplementedError()
+
+    def get(self, name):
+        """Returns the content of the entry, None when missing."""
+        fd = self.stream(name)
+        if fd is None:
+            return None
+        with fd:
+            return fd.read()
+
+    def stream(self, name):
+        """Returns a readable and seekable file object of the entry content,
+        None when missing. Records an access to the entry."""
+        raise NotImplementedError()
+
+    def put(self, name, path, info):
+        """Moves the file at ``path`` in the cache, replacing the entry."""
+        raise NotImplementedError()
+
+    def remove(self, name):
+        raise NotImplementedError()
+
+    def clear(self):
+        for entry in self.stats():
+            self.remove(entry["name"])
+
+    def stats(self):
+        """Returns the entries, the least recently used first."""
+        raise NotImplementedError()
+
+    def total_size(self):
+        return sum(entry["size"] for entry in self.stats())
+
+    def evict(self, max_size, keep=()):
+        """Removes the least recently used entries until the cache size is
+        below ``max_size`` bytes, and returns them. The ``keep`` entries are
+        never evicted."""
+        evicted = []
+        entries = self.stats()
+        total_size = sum(entry["size"] for entry in entries)
+        for entry in entries:
+            if total_size <= max_size:
+                break
+            if entry["name"] in keep:
+                continue
+            self.remove(entry["name"])
+            total_size -= entry["size"]
+            evicted.append(entry)
+        return evicted
+
+    def prefixed_names(self, name):
+        """Returns the names of the existing entries ``<prefix>/<name>``, the
+        most recently used last."""
+        suffix = "/" + name
+        return [
+            entry["name"]
+            for entry in self.stats()
+            if entry["name"].endswith(suffix)
+            and entry["name"].count("/") == suffix.count("/")
+        ]
+
+    def move(self, name, new_name):
+        """Renames the entry ``name``, returns False when it is missing."""
+        info = self.info(name)
+        fd = None if info is None else self.stream(name)
+        if fd is None:
+            return False
+        temp_fd, path = self.mkstemp(new_name)
+        with fd, open(temp_fd, "wb") as temp_file:
+            shutil.copyfileobj(fd, temp_file, BLOCK_SIZE)
+        self.remove(name)
+        self.put(new_name, path, info)
+        return True
+
+    def lock(self, name):
+        """Returns the lock of the entry, held while it is being written."""
+        return NullLock()
+
+    def mkstemp(self, name):
+        """Creates the temporary file the new content of the entry is written
+        to, returns its file descriptor and path."""
+        return tempfile.mkstemp(prefix="dbcut-", suffix=".tmp")
+
+
+class DirectoryCacheBackend(CacheBackend):
+    """Stores each entry in a ``.cache`` file and a ``.count`` JSON file of
+    the cache directory, indexed by the cache manifest."""
+
+    def __init__(self, path):
+        self.path = create_directory(path)
+        self.manifest = CacheManifest(self.path)
+
+    def __str__(self):
+        return self.path
+
+    def basename(self, name):
+        return os.path.join(self.path, *name.split("/"))
+
+    def info(self, name):
+        basename = self.basename(name)
+        if not os.path.isfile(basename + ".cache"):
+            return None
+        try:
+            return load_json(basename + ".count")
+        except (IOError, ValueError):
+            return None
+
+    def stream(self, name):
+        basename = self.basename(name)
+        try:
+            fd = open_cache_file(basename + ".cache")
+        except IOError:
+            return None
+        model, key = parse_entry_name(name)
+        self.manifest.hit(key, model, basename)
+        return fd
+
+    def put(self, name, path, info):
+        basename = self.basename(name)
+        create_directory(os.path.dirname(basename))
+        os.replace(path, basename + ".cache")
+        # The count file is written last, the entry is complete once it exists
+        with atomic_path(basename + ".count") as count_path:
+            dump_json(info, count_path)
+        model, key = parse_entry_name(name)
+        self.manifest.add(key, model, basename)
+
+    def remove(self, name):
+        basename = self.basename(name)
+        for extension in (".count", ".cache"):
+            if os.path.exists(basename + extension):
+                os.remove(basename + extension)
+        self.manifest.remove(parse_entry_name(name)[1])
+
+    def clear(self):
+        extensions = (".cache", ".count", ".lock", ".tmp")
+        for root, dirs, files in os.walk(self.path):
+            for file_name in files:
+                if file_name.endswith(extensions):
+                    os.remove(os.path.join(root, file_name))
+        self.manifest.clear()
+
+    def entry_name(self, basename):
+        return "/".join(os.path.relpath(basename, self.path).split(os.sep))
+
+    def to_entry(self, row):
+        entry = dict(row)
+        entry["name"] = self.entry_name(entry.pop("basename"))
+        return entry
+
+    def stats(self):
+        return [self.to_entry(row) for row in self.manifest.entries()]
+
+    def total_size(self):
+        return self.manifest.total_size()
+
+    def evict(self, max_size, keep=()):
+        keep = [parse_entry_name(name)[1] for name in keep]
+        return [self.to_entry(row) for row in self.manifest.evict(max_size, keep)]
+
+    def prefixed_names(self, name):
+        # The entries written before the manifest are not indexed
+        basename = os.path.relpath(self.basename(name), self.path)
+        pattern = os.path.join(glob.escape(self.path), "*", glob.escape(basename))
+        paths = sorted(glob.glob(pattern + ".cache"), key=os.path.getmtime)
+        return [self.entry_name(path[: -len(".cache")]) for path in paths]
+
+    def lock(self, name):
+        basename = self.basename(name)
+        create_directory(os.path.dirname(basename))
+        return CacheLock(basename + ".lock")
+
+    def mkstemp(self, name):
+        # In the directory of the entry, so that it is renamed atomically
+        directory, basename = os.path.split(self.basename(name))
+        create_directory(directory)
+        return tempfile.mkstemp(dir=directory, prefix=basename + ".", suffix=".tmp")
+
+
+class SqliteCacheBackend(CacheBackend):
+    """Stores the entries as blobs of a single SQLite file, each entry is
+    replaced in one transaction."""
+
+    def __init__(self, path):
+        self.path = os.path.realpath(os.path.expanduser(path))
+        create_directory(os.path.dirname(self.path))
+        with self.connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " name TEXT PRIMARY KEY,"
+                " key TEXT,"
+                " model TEXT,"
+                " info TEXT,"
+                " data BLOB,"
+                " size INTEGER,"
+                " created REAL,"
+                " last_access REAL,"
+                " hits INTEGER DEFAULT 0)"
+            )
+
+    def __str__(self):
+        return "sqlite:///%s" % self.path
+
+    @contextmanager
+    def connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield con
+            con.commit()
+        finally:
+            con.close()
+
+    def info(self, name):
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT info FROM entries WHERE name = ?", (name,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def stream(self, name):
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT data FROM entries WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                return None
+            con.execute(
+                "UPDATE entries SET hits = hits + 1, last_access = ? WHERE name = ?",
+                (time.time(), name),
+            )
+        return BytesIO(row[0])
+
+    def put(self, name, path, info):
+        with open(path, "rb") as fd:
+            data = fd.read()
+        os.remove(path)
+        model, key = parse_entry_name(name)
+        now = time.time()
+        with self.connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (name, key, model, json.dumps(info), data, len(data), now, now),
+            )
+
+    def remove(self, name):
+        with self.connect() as con:
+            con.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def clear(self):
+        with self.connect() as con:
+            con.execute("DELETE FROM entries")
+
+    def stats(self):
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            rows = con.execute(
+                "SELECT name, key, model, size, created, last_access, hits"
+                " FROM entries ORDER BY last_access"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Keeps the entries in memory, for the library use and the tests."""
+
+    def __init__(self):
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "memory://"
+
+    def info(self, name):
+        entry = self.entries.get(name)
+        return None if entry is None else dict(entry["info"])
+
+    def stream(self, name):
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            entry["hits"] += 1
+            entry["last_access"] = time.time()
+        return BytesIO(entry["data"])
+
+    def put(self, name, path, info):
+        with open(path, "rb") as fd:
+            data = fd.read()
+        os.remove(path)
+        model, key = parse_entry_name(name)
+        now = time.time()
+        with self._lock:
+            self.entries[name] = {
+                "name": name,
+                "key": key,
+                "model": model,
+                "info": dict(info),
+                "data": data,
+                "size": len(data),
+                "created": now,
+                "last_access": now,
+                "hits": 0,
+            }
+
+    def remove(self, name):
+        with self._lock:
+            self.entries.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            entries = [
+                {k: v for k, v in entry.items() if k not in ("info", "data")}
+                for entry in self.entries.values()
+            ]
+        return sorted(entries, key=lambda entry: entry["last_access"])
+
+
+class HttpCacheBackend(CacheBackend):
+    """Stores the entries in an HTTP object store shared by a team: the
+    ``<name>.cache`` and ``<name>.count`` objects are read with GET, written
+    with PUT and removed with DELETE. The retention of the entries is left to
+    the store, they are neither listed nor evicted.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.url
+
+    def request(self, method, path, data=None, headers=None):
+        request = Request(
+            "%s/%s" % (self.url, path), data=data, headers=headers or {}, method=method
+        )
+        return urlopen(request, timeout=self.timeout)
+
+    def info(self, name):
+        try:
+            with self.request("GET", name + ".count") as response:
+                return json.loads(response.read().decode("utf-8"))
+        except HTTPError as exc:
+            if exc.code == 404:
+                return None
+            raise
+
+    def stream(self, name):
+        fd = tempfile.TemporaryFile()
+        try:
+            with self.request("GET", name + ".cache") as response:
+                shutil.copyfileobj(response, fd, BLOCK_SIZE)
+        except HTTPError as exc:
+            fd.close()
+            if exc.code == 404:
+                return None
+            raise
+        fd.seek(0)
+        return fd
+
+    def put(self, name, path, info):
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(os.path.getsize(path)),
+        }
+        try:
+            with open(path, "rb") as fd:
+                self.request("PUT", name + ".cache", data=fd, headers=headers).close()
+        finally:
+            os.remove(path)
+        data = json.dumps(info).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        self.request("PUT", name + ".count", data=data, headers=headers).close()
+
+    def remove(self, name):
+        for extension in (".count", ".cache"):
+            try:
+                self.request("DELETE", name + extension).close()
+            except HTTPError as exc:
+                if exc.code != 404:
+                    raise
+
+    def clear(self):
+        raise NotImplementedError("The entries of an HTTP cache can not be listed")
+
+    def stats(self):
+        return []
+
+
+def is_cache_url(cache):
+    return "://" in cache
+
+
+def get_cache_backend(cache):
+    """Returns the cache backend of a directory path or of a cache URL."""
+    if isinstance(cache, CacheBackend):
+        return cache
+    if not is_cache_url(cache):
+        return DirectoryCacheBackend(cache)
+    scheme, _, path = cache.partition("://")
+    if scheme == "file":
+        return DirectoryCacheBackend(path)
+    if scheme == "sqlite":
+        # Like the SQLAlchemy URLs: sqlite:///relative.db, sqlite:////absolute.db
+        return SqliteCacheBackend(path[1:] if path.startswith("/") else path)
+    if scheme == "memory":
+        return MemoryCacheBackend()
+    if scheme in ("http", "https"):
+        return HttpCacheBackend(cache)
+    raise ValueError("Unknown cache backend %r" % cache)
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ..context import global_options, pass_context, profiler_option
+from ..operations import cache_stats
+
+
+@click.command("cachestats")
+@profiler_option()
+@global_options()
+@pass_context
+def cli(ctx, **kwargs):
+    """ Show the cached queries and the cache disk usage."""
+    cache_stats(ctx)
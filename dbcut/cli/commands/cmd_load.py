@@ -4,7 +4,14 @@
 
 import click
 
-from ..context import global_options, pass_context, profiler_option
+from ...loaders import INSERT_MODES
+from ..context import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_QUEUE_DEPTH,
+    global_options,
+    pass_context,
+    profiler_option,
+)
 from ..operations import load
 
 
@@ -32,6 +39,14 @@ def load_options():
                 default=False,
                 help="Force refresh all cached queries",
             ),
+            click.option(
+                "--refresh",
+                "refresh",
+                is_flag=True,
+                default=False,
+                help="Refresh all cached queries, incrementally for the queries"
+                " with an incremental column",
+            ),
             click.option(
                 "-l",
                 "--last-only",
@@ -39,6 +54,64 @@ def load_options():
                 default=False,
                 help="Executes only the last query",
             ),
+            click.option(
+                "--batch-size",
+                "batch_size",
+                type=click.IntRange(min=0),
+                default=DEFAULT_BATCH_SIZE,
+                show_default=True,
+                help="Number of objects inserted and committed at once (0 to disable)",
+            ),
+            click.option(
+                "-j",
+                "--jobs",
+                "jobs",
+                type=click.IntRange(min=1),
+                default=1,
+                show_default=True,
+                help="Number of queries fetched concurrently from the source",
+            ),
+            click.option(
+                "--queue-depth",
+                "queue_depth",
+                type=click.IntRange(min=0),
+                default=DEFAULT_QUEUE_DEPTH,
+                show_default=True,
+                help="Number of batches fetched ahead of the insert (0 to disable)",
+            ),
+            click.option(
+                "--insert-mode",
+                "insert_mode",
+                type=click.Choice(list(INSERT_MODES)),
+                default=None,
+                help="How rows are inserted: through the ORM unit of work (default),"
+                " with bulk executemany statements or with the native bulk load of"
+                " the destination database",
+            ),
+            click.option(
+                "--fast-load",
+                "fast_load",
+                is_flag=True,
+                default=False,
+                help="Disable the journal and synchronous writes of a SQLite"
+                " destination during the load",
+            ),
+            click.option(
+                "--defer-indexes",
+                "defer_indexes",
+                is_flag=True,
+                default=False,
+                help="Create the indexes and unique constraints of the new tables"
+                " after the data load",
+            ),
+            click.option(
+                "--in-memory",
+                "in_memory",
+                is_flag=True,
+                default=False,
+                help="Build a SQLite destination in memory and write it to the"
+                " database file at the end of the load",
+            ),
         ]
         for option in options:
             option(f)
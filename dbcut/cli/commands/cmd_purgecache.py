@@ -8,6 +8,13 @@ from ..operations import purge_cache
 
 @click.command("purgecache")
 @profiler_option()
+@click.option(
+    "--unreachable",
+    "unreachable",
+    is_flag=True,
+    default=False,
+    help="Only remove the cached queries which are not in the configuration",
+)
 @global_options()
 @pass_context
 def cli(ctx, **kwargs):
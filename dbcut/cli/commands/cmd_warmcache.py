@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ..context import DEFAULT_BATCH_SIZE, global_options, pass_context, profiler_option
+from ..operations import warm_cache
+
+
+@click.command("warmcache")
+@profiler_option()
+@click.option(
+    "--only",
+    "only_tables",
+    help="Executes only queries for the given tables",
+    multiple=True,
+)
+@click.option(
+    "--force-refresh",
+    "force_refresh",
+    is_flag=True,
+    default=False,
+    help="Force refresh all cached queries",
+)
+@click.option(
+    "--batch-size",
+    "batch_size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of objects per cached chunk (0 to disable)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    "jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of queries fetched concurrently from the source, each one"
+    " with its own connection",
+)
+@global_options()
+@pass_context
+def cli(ctx, **kwargs):
+    """ Execute the queries which are not cached yet and write their cache."""
+    warm_cache(ctx)
@@ -12,7 +12,9 @@ from sqlalchemy import event
 from sqlalchemy.engine import Engine
 from sqlalchemy.engine.url import make_url
 
+from ..cache_backends import is_cache_url
 from ..database import Database
+from ..parser import get_query_reach
 from ..utils import cached_property, expand_env_variables, pickle_copy, reraise
 
 magenta = lambda x, **kwargs: click.style("%s" % x, fg="magenta", **kwargs)  # noqa
@@ -25,6 +27,13 @@ red = lambda x, **kwargs: click.style("%s" % x, fg="red", **kwargs)  # noqa
 
 CONTEXT_SETTINGS = dict(auto_envvar_prefix="dbcut", help_option_names=["-h", "--help"])
 
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_QUEUE_DEPTH = 4
+
+# "full" reflects the whole source schema, "partial" only the tables reached
+# from the queries
+REFLECT_MODES = ("full", "partial")
+
 
 class Context(object):
     def __init__(self):
@@ -37,16 +46,28 @@ class Context(object):
             "export_json",
             "drop_db",
             "force_refresh",
+            "refresh",
             "last_only",
             "no_cache",
             "profiler",
             "interactive",
             "estimate",
             "with_cache",
+            "fast_load",
+            "defer_indexes",
+            "in_memory",
+            "unreachable",
         ]
         for flag in self.flags:
             setattr(self, flag, False)
         self.only_tables = []
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.insert_mode = None
+        self.jobs = 1
+        self.queue_depth = DEFAULT_QUEUE_DEPTH
+        self.queue_high_water_mark = 0
+        self.deferred_indexes = []
+        self.index_build_time = None
         self._log_configured = False
         self.is_tty = sys.stdout.isatty()
         self.tty_columns, self.tty_rows = shutil.get_terminal_size(fallback=(80, 24))
@@ -70,18 +91,43 @@ class Context(object):
         return Database(
             uri=self.dest_db_uri,
             echo_sql=self.dump_sql,
-            cache_dir=self.config["cache"],
+            cache_dir=self.cache_dir,
             enable_cache=False,
             metadata=pickle_copy(self.src_db.metadata),
+            session_options={"expire_on_commit": False},
         )
 
+    @property
+    def cache_dir(self):
+        """The directory of the reflected metadata cache, the default one
+        when the query cache is stored by a cache URL."""
+        cache = self.config["cache"]
+        if cache and not is_cache_url(cache):
+            return cache
+
+    @property
+    def reachable_from(self):
+        """The tables the queries start from and how far they reach, when only
+        those tables are to be reflected."""
+        reflect_mode = self.config["reflect_mode"]
+        if reflect_mode not in REFLECT_MODES:
+            raise ValueError("Unknown reflect mode: %s" % reflect_mode)
+        if reflect_mode == "partial":
+            return [
+                get_query_reach(query, self.config) for query in self.config["queries"]
+            ]
+
     @cached_property
     def src_db(self):
         return Database(
             uri=self.src_db_uri,
             echo_sql=False,
-            cache_dir=self.config["cache"],
+            cache_dir=self.cache_dir,
+            cache_backend=self.config["cache"],
+            cache_compression=self.config["cache_compression"],
+            cache_max_size=self.config["cache_max_size"],
             enable_cache=(not self.no_cache),
+            reachable_from=self.reachable_from,
         )
 
     def configure_log(self):
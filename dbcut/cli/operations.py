@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
 import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from itertools import chain
 
+import click
 from sqlalchemy_utils.functions import create_database, database_exists, drop_database
 from tabulate import tabulate
 from tqdm import tqdm
 
+from ..cache import CacheChunk
+from ..exceptions import CorruptedCacheError
+from ..loaders import get_loader
 from ..parser import parse_query
 from ..serializer import dump_yaml
-from ..utils import get_directory_size, to_unicode
+from ..utils import (
+    BackgroundIterator,
+    QueueIterator,
+    chunks,
+    get_peak_memory,
+    to_unicode,
+)
+
+# The messages of the fetch are logged by ``copy_query``, in the order of the
+# queries, as ``(message, quietable)`` pairs
+FetchedQuery = namedtuple(
+    "FetchedQuery", ["query", "groups_generator", "count", "using_cache", "messages"]
+)
 
 
 def get_raw_queries(ctx):
@@ -38,51 +57,262 @@ def db_profiling(ctx):
         ctx.dest_db.profiler_stats()
 
 
-def get_objects_generator(ctx, query, session):
+@contextmanager
+def sqlite_fast_load(ctx):
+    if ctx.fast_load and ctx.dest_db.dialect == "sqlite":
+        ctx.log(" ---> SQLite fast-load mode : journal and synchronous writes disabled")
+        with ctx.dest_db.sqlite_fast_load():
+            yield
+        ctx.log(" ---> Restored SQLite safe settings and analyzed tables")
+    else:
+        yield
+
 
-    if ctx.no_cache or ctx.force_refresh or not query.is_cached:
-        using_cache = False
-        count = query.count()
-        generator = query.objects()
+@contextmanager
+def sqlite_in_memory(ctx):
+    file_based = ctx.dest_db.uri.database not in (None, "", ":memory:")
+    if ctx.in_memory and ctx.dest_db.dialect == "sqlite" and file_based:
+        check_memory_budget(ctx)
+        ctx.log(" ---> SQLite in-memory mode : building the database in memory")
+        with ctx.dest_db.sqlite_in_memory():
+            yield
+        ctx.log(
+            " ---> Wrote the in-memory database to %s" % repr(ctx.dest_db.uri.database)
+        )
+        peak_memory = get_peak_memory()
+        if peak_memory is not None:
+            ctx.log(" ---> Peak memory : %.1f MB" % peak_memory)
     else:
-        using_cache = True
-        count, data = query.load_from_cache(session=session)
-        generator = (obj for obj in data)
+        yield
+
+
+def estimate_subset_size(ctx):
+    """Roughly estimates the size in MB of the destination database, from the
+    sizes of the source tables queried and of the existing destination."""
+    size = 0
+    path = ctx.dest_db.uri.database
+    if os.path.exists(path):
+        size += os.path.getsize(path)
+    table_sizes = {
+        name: (rows, table_size)
+        for name, rows, table_size in ctx.src_db.estimate_table_sizes()
+    }
+    for raw_query in get_raw_queries(ctx):
+        rows, table_size = table_sizes.get(raw_query["from"], (0, 0))
+        limit = raw_query.get("limit", ctx.config["default_limit"])
+        if limit in (None, False) or not rows:
+            size += table_size
+        else:
+            size += table_size * min(1, limit / float(rows))
+    return size / (1024 * 1024.0)
+
+
+def check_memory_budget(ctx):
+    memory_budget = ctx.config["memory_budget"]
+    if memory_budget is None:
+        return
+    estimated_size = estimate_subset_size(ctx)
+    ctx.log(
+        " ---> Estimated database size : %.1f MB (budget : %d MB)"
+        % (estimated_size, memory_budget)
+    )
+    if estimated_size > memory_budget:
+        raise click.ClickException(
+            "The estimated database size (%.1f MB) exceeds the memory_budget"
+            " (%d MB) of the in-memory mode" % (estimated_size, memory_budget)
+        )
+
+
+def is_refreshed(ctx, query):
+    """Tells if the query is executed (and its cache entry written)."""
+    return ctx.force_refresh or ctx.refresh or not query.is_cached
+
+
+def get_groups_generator(ctx, query, session, show_progressbar=True):
+
+    messages = []
+    using_cache = False
+    refreshed = derived = None
+    if not ctx.no_cache:
+        if is_refreshed(ctx, query):
+            # Wait for the other processes writing the same cache entry, the
+            # lock is released once the query is copied
+            query.lock_cache()
+        if not is_refreshed(ctx, query):
+            query.unlock_cache()
+            try:
+                count, generator = query.load_from_cache(session=session)
+                using_cache = True
+            except CorruptedCacheError as exc:
+                messages.append((" ---> Ignored corrupted cache : %s" % exc, False))
+                query.lock_cache()
+        elif ctx.refresh and query.is_cached:
+            try:
+                refreshed = query.refreshed_groups(session=session)
+            except CorruptedCacheError as exc:
+                messages.append((" ---> Ignored corrupted cache : %s" % exc, False))
+        elif not ctx.force_refresh:
+            try:
+                derived = query.subsumed_groups(session=session)
+            except CorruptedCacheError as exc:
+                messages.append((" ---> Ignored corrupted cache : %s" % exc, False))
+    if refreshed is not None:
+        messages.append(
+            (" ---> Incremental refresh on %s" % query.incremental_column.name, True)
+        )
+        count, generator = refreshed
+    elif derived is not None:
+        messages.append((" ---> Derived from a cached larger result", True))
+        count, generator = derived
+    elif not using_cache:
+        count = query.count()
+        generator = query.object_groups()
 
-    def objects_generator():
+    def groups_generator():
         progressbar = None
 
-        obj = next(generator, None)
-        if obj is not None:
-            fetch_generator = chain([obj], generator)
+        group = next(generator, None)
+        if group is not None:
+            fetch_generator = chain([group], generator)
         else:
             fetch_generator = generator
 
         yield
 
-        if not using_cache:
+        if not using_cache and show_progressbar:
             progressbar = tqdm(total=count, leave=False)
 
-        for obj in fetch_generator:
-            yield obj
+        for group in fetch_generator:
+            yield group
             if progressbar is not None:
-                progressbar.update(1)
+                progressbar.update(len(group))
 
         if progressbar is not None:
             progressbar.close()
 
-    return objects_generator(), count, using_cache
+    return groups_generator(), count, using_cache, messages
 
 
-def save_query_cache(ctx, query, objects):
-    if ctx.no_cache:
+def fetch_query(ctx, dict_query, session, prefetch=False):
+    query = parse_query(dict_query.copy(), ctx.src_db.session, ctx.config)
+    groups_generator, count, using_cache, messages = get_groups_generator(
+        ctx, query, session, show_progressbar=not prefetch
+    )
+    return FetchedQuery(query, groups_generator, count, using_cache, messages)
+
+
+def prefetch_query(ctx, dict_query, session, fetched_items):
+    """Parses and fetches the query from a worker thread. The fetched query,
+    then its groups of objects, are handed over through the bounded
+    ``fetched_items`` queue."""
+
+    def iter_fetched_items():
+        fetched_query = fetch_query(ctx, dict_query, session, prefetch=True)
+        groups_generator = fetched_query.groups_generator
+        next(groups_generator)
+        yield fetched_query._replace(groups_generator=None)
+        yield from groups_generator
+
+    try:
+        fetched_items.produce(iter_fetched_items())
+    finally:
+        ctx.src_db.session.remove()
+
+
+def receive_fetched_query(fetched_items):
+    items = iter(fetched_items)
+    fetched_query = next(items)
+    return fetched_query._replace(groups_generator=chain([None], items))
+
+
+def iter_fetched_queries(ctx, raw_queries, session):
+    if ctx.jobs <= 1 or ctx.interactive:
+        for dict_query in raw_queries:
+            yield fetch_query(ctx, dict_query, session)
         return
-    if ctx.force_refresh or not query.is_cached:
-        query.save_to_cache(objects=objects)
 
+    # Queries are fetched concurrently by the workers but are always yielded
+    # in order, so that the destination writes and logs stay sequential. Each
+    # worker streams the objects of its query through a bounded queue.
+    maxsize = max(ctx.queue_depth, 1)
+    with ThreadPoolExecutor(max_workers=ctx.jobs) as executor:
+        pending = deque()
+        try:
+            for dict_query in raw_queries:
+                fetched_items = QueueIterator(maxsize)
+                future = executor.submit(
+                    prefetch_query, ctx, dict_query, session, fetched_items
+                )
+                pending.append((future, fetched_items))
+                if len(pending) > ctx.jobs:
+                    yield receive_fetched_query(pending[0][1])
+                    pending.popleft()[1].stop()
+            while pending:
+                yield receive_fetched_query(pending[0][1])
+                pending.popleft()[1].stop()
+        finally:
+            # Unblocks the workers of the queries which are not copied
+            for future, fetched_items in pending:
+                future.cancel()
+                fetched_items.stop()
+
+
+@contextmanager
+def query_cache_writer(ctx, query):
+    if ctx.no_cache or not is_refreshed(ctx, query):
+        yield None
+    else:
+        with query.cache_writer() as writer:
+            yield writer
+        if writer.evicted:
+            ctx.log(
+                " ---> Evicted %d cache entries (%.1f MB)"
+                % (
+                    len(writer.evicted),
+                    sum(entry["size"] for entry in writer.evicted) / (1024 * 1024.0),
+                )
+            )
+
+
+def iter_batches(ctx, query, groups_generator):
+    # The objects of a group share the same instances of their related rows,
+    # a batch never overlaps two groups so that the same row is not added
+    # twice to the destination session
+    with query_cache_writer(ctx, query) as cache_writer:
+        for group in groups_generator:
+            if isinstance(group, CacheChunk):
+                # The cached chunks are already cut to the batch size
+                yield group
+                continue
+            for batch in chunks(group, ctx.batch_size):
+                if cache_writer is not None:
+                    cache_writer.write(batch)
+                yield batch
+
+
+def get_insert_mode(ctx):
+    return ctx.insert_mode or ctx.config["insert_mode"]
+
+
+def insert_batches(ctx, session, batches):
+    loader = get_loader(get_insert_mode(ctx), session)
+    for batch in batches:
+        if isinstance(batch, CacheChunk):
+            loader.load_rows(batch.rows_by_table())
+        else:
+            loader.load(batch)
+    return loader.inserted
+
+
+def iter_batches_objects(ctx, batches):
+    for batch in batches:
+        if isinstance(batch, CacheChunk):
+            batch = batch.to_objects(ctx.src_db)
+        yield from batch
 
-def copy_query(ctx, query, session, query_index, number_of_queries):
-    objects_generator, count, using_cache = get_objects_generator(ctx, query, session)
+
+def copy_query(ctx, fetched_query, session, query_index, number_of_queries):
+    query, groups_generator, count, using_cache, messages = fetched_query
 
     ctx.log("")
     ctx.log("Query %d/%d : " % ((query_index + 1), number_of_queries), nl=False)
@@ -97,6 +327,8 @@ def copy_query(ctx, query, session, query_index, number_of_queries):
         ctx.log(" ---> Cache : disabled", quietable=True)
     else:
         ctx.log(" ---> Cache key : %s" % query.cache_key, quietable=True)
+    for message, quietable in messages:
+        ctx.log(message, quietable=quietable)
 
     continue_operation = True
     if ctx.interactive:
@@ -108,20 +340,26 @@ def copy_query(ctx, query, session, query_index, number_of_queries):
         else:
             ctx.log(" ---> Executing query")
 
-        next(objects_generator)
+        next(groups_generator)
 
         if count:
             ctx.log(" ---> Fetching objects")
-            objects_to_serialize = list(objects_generator)
-            save_query_cache(ctx, query, objects_to_serialize)
+            batches = iter_batches(ctx, query, groups_generator)
+            if ctx.queue_depth:
+                # Fetch the next batches while the current one is written
+                batches = pipeline = BackgroundIterator(batches, ctx.queue_depth)
 
             if ctx.export_json:
                 ctx.log(" ---> Exporting json to {}".format(query.json_file))
-                query.export_to_json(objects_to_serialize)
+                query.export_to_json(iter_batches_objects(ctx, batches))
             else:
-                session.add_all(objects_to_serialize)
-                ctx.log(" ---> Inserting {} rows".format(len(list(session))))
-                session.commit()
+                inserted = insert_batches(ctx, session, batches)
+                ctx.log(" ---> Inserted {} rows".format(inserted))
+
+            if ctx.queue_depth:
+                ctx.queue_high_water_mark = max(
+                    ctx.queue_high_water_mark, pipeline.high_water_mark
+                )
 
         else:
             ctx.log(" ---> Nothing to do")
@@ -129,14 +367,61 @@ def copy_query(ctx, query, session, query_index, number_of_queries):
         ctx.log(" ---> Skipped")
 
 
+def log_load_summary(ctx):
+    counter = ctx.dest_db.statements_counter
+    statement_types = sorted(set(counter) | {"INSERT", "UPDATE"})
+    summary = ", ".join("%s: %d" % (t, counter[t]) for t in statement_types)
+    ctx.log("")
+    ctx.log(" ---> Destination statements : %s" % summary)
+    if ctx.queue_depth:
+        ctx.log(
+            " ---> Queue high-water mark : %d/%d batches"
+            % (ctx.queue_high_water_mark, ctx.queue_depth)
+        )
+
+
 def load_data(ctx):
-    with db_profiling(ctx):
-        with ctx.dest_db.no_fkc_session() as session:
-            raw_queries = get_raw_queries(ctx)
-            number_of_queries = len(raw_queries)
-            for query_index, dict_query in enumerate(raw_queries):
-                query = parse_query(dict_query.copy(), ctx.src_db.session, ctx.config)
-                copy_query(ctx, query, session, query_index, number_of_queries)
+    ctx.dest_db.statements_counter.clear()
+    ctx.queue_high_water_mark = 0
+    with db_profiling(ctx), sqlite_fast_load(ctx):
+        start = time.time()
+        try:
+            with ctx.dest_db.no_fkc_session() as session:
+                raw_queries = get_raw_queries(ctx)
+                number_of_queries = len(raw_queries)
+                fetched_queries = iter_fetched_queries(ctx, raw_queries, session)
+                for query_index, fetched_query in enumerate(fetched_queries):
+                    try:
+                        copy_query(
+                            ctx, fetched_query, session, query_index, number_of_queries
+                        )
+                    finally:
+                        fetched_query.query.unlock_cache()
+            load_time = time.time() - start
+        finally:
+            # Even when the load fails: the next loads do not create the tables,
+            # nor their indexes, again
+            create_deferred_indexes(ctx)
+    log_load_summary(ctx)
+    ctx.log(" ---> Load time : %.2fs" % load_time)
+    if ctx.index_build_time is not None:
+        ctx.log(
+            " ---> Index build time : %.2fs (%d indexes)"
+            % (ctx.index_build_time, ctx.number_of_deferred_indexes)
+        )
+
+
+def create_deferred_indexes(ctx):
+    ctx.index_build_time = None
+    if not ctx.deferred_indexes:
+        return
+    ctx.log("")
+    ctx.log(" ---> Creating %d deferred indexes" % len(ctx.deferred_indexes))
+    start = time.time()
+    ctx.dest_db.create_indexes(ctx.deferred_indexes, jobs=ctx.jobs)
+    ctx.index_build_time = time.time() - start
+    ctx.number_of_deferred_indexes = len(ctx.deferred_indexes)
+    ctx.deferred_indexes = []
 
 
 def sync_schema(ctx):
@@ -156,7 +441,9 @@ def create_db(ctx):
 def create_tables(ctx, checkfirst=True):
     ctx.dest_db.prepare()
     ctx.log(" ---> Creating all tables and relations on %s" % repr(ctx.dest_db_uri))
-    ctx.dest_db.create_all(checkfirst=checkfirst)
+    ctx.deferred_indexes = ctx.dest_db.create_all(
+        checkfirst=checkfirst, defer_indexes=ctx.defer_indexes
+    )
 
 
 def flush(ctx):
@@ -182,8 +469,73 @@ def clear(ctx):
 
 
 def load(ctx):
-    sync_schema(ctx)
-    load_data(ctx)
+    with sqlite_in_memory(ctx):
+        sync_schema(ctx)
+        load_data(ctx)
+
+
+def warm_query(ctx, dict_query):
+    """Executes a query and writes its cache entry from a worker thread, the
+    query already cached are skipped."""
+    start = time.time()
+    try:
+        query = parse_query(dict_query.copy(), ctx.src_db.session, ctx.config)
+        # A single connection per query, --jobs bounds the source connections
+        query.fetch_options = dict(query.fetch_options, shards=None)
+        if query.is_cached and not ctx.force_refresh:
+            return query, None
+        query.lock_cache()
+        try:
+            if query.is_cached and not ctx.force_refresh:
+                return query, None
+            with query.cache_writer() as writer:
+                for group in query.object_groups():
+                    for batch in chunks(group, ctx.batch_size):
+                        writer.write(batch)
+        finally:
+            query.unlock_cache()
+        return query, (time.time() - start, writer)
+    finally:
+        ctx.src_db.session.remove()
+
+
+def warm_cache(ctx):
+    if ctx.no_cache:
+        raise click.ClickException("The cache is disabled")
+    ctx.src_db.reflect()
+    raw_queries = get_raw_queries(ctx)
+    rows = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=ctx.jobs) as executor:
+        futures = [
+            executor.submit(warm_query, ctx, dict_query) for dict_query in raw_queries
+        ]
+        for index, future in enumerate(futures):
+            query, result = future.result()
+            name = "%s-%s" % (query.model_class.__name__, query.cache_key[:12])
+            if result is None:
+                ctx.log(" ---> %s : cached" % name)
+                rows.append((index + 1, name, "cached", "", "", ""))
+                continue
+            duration, writer = result
+            status = "not cacheable" if writer.failed else "fetched"
+            ctx.log(" ---> %s : %s in %.2fs" % (name, status, duration))
+            rows.append(
+                (
+                    index + 1,
+                    name,
+                    status,
+                    "%.2f" % duration,
+                    writer.count,
+                    "%.1f" % (writer.size / 1024.0),
+                )
+            )
+
+    headers = ["Query", "Cache entry", "Status", "Fetch time (s)", "Rows", "Size (KB)"]
+    ctx.log("")
+    ctx.log(tabulate(rows, headers=headers), prefix="    ")
+    ctx.log("")
+    ctx.log(" ---> Warm-up time : %.2fs" % (time.time() - start))
 
 
 def inspect_db(ctx):
@@ -221,26 +573,82 @@ def inspect_db(ctx):
     ctx.log(" ---> Cache ")
     ctx.log("")
     ctx.log("location : %s" % ctx.config["cache"], prefix="    ")
-    ctx.log(
-        "Disk usage : %.1f MB" % get_directory_size(ctx.config["cache"]), prefix="    "
-    )
+    disk_usage = ctx.src_db.cache_backend.total_size() / (1024 * 1024.0)
+    ctx.log("Disk usage : %.1f MB" % disk_usage, prefix="    ")
     ctx.log("")
 
 
-def purge_cache(ctx):
-    included_extensions = ["cache", "count"]
+def cache_stats(ctx):
+    backend = ctx.src_db.cache_backend
+    entries = backend.stats()
+    rows = [
+        (
+            entry["model"],
+            entry["key"][:12],
+            "%.1f" % (entry["size"] / 1024.0),
+            format_timestamp(entry["created"]),
+            format_timestamp(entry["last_access"]),
+            entry["hits"],
+        )
+        for entry in reversed(entries)
+    ]
+    headers = ["Model", "Key", "Size (KB)", "Created", "Last access", "Hits"]
 
-    def listfiles(path):
-        for r, d, f in os.walk(path):
-            for file in f:
-                yield os.path.join(r, file)
+    ctx.log(" ---> Cache entries ")
+    ctx.log("")
+    ctx.log(tabulate(rows, headers=headers), prefix="    ")
+    ctx.log("")
+    ctx.log("location : %s" % ctx.config["cache"], prefix="    ")
+    ctx.log("Entries : %d" % len(entries), prefix="    ")
+    ctx.log("Hits : %d" % sum(entry["hits"] for entry in entries), prefix="    ")
+    disk_usage = backend.total_size() / (1024 * 1024.0)
+    max_size = ctx.config["cache_max_size"]
+    if max_size is None:
+        ctx.log("Disk usage : %.1f MB" % disk_usage, prefix="    ")
+    else:
+        ctx.log("Disk usage : %.1f MB / %g MB" % (disk_usage, max_size), prefix="    ")
+    ctx.log("")
 
-    file_names = [
-        fn
-        for fn in listfiles(ctx.config["cache"])
-        if any(fn.endswith(ext) for ext in included_extensions)
-    ]
 
-    for file in file_names:
-        os.remove(file)
+def format_timestamp(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def purge_cache(ctx):
+    if ctx.unreachable:
+        return purge_unreachable_cache(ctx)
+
+    try:
+        ctx.src_db.cache_backend.clear()
+    except NotImplementedError as exc:
+        raise click.ClickException(str(exc))
     ctx.log(" ---> Purged all cache")
+
+
+def get_reachable_cache_keys(ctx):
+    ctx.src_db.reflect()
+    keys = set()
+    for dict_query in ctx.config["queries"]:
+        query = parse_query(dict_query.copy(), ctx.src_db.session, ctx.config)
+        keys.add(query.cache_key)
+    return keys
+
+
+def purge_unreachable_cache(ctx):
+    reachable_keys = get_reachable_cache_keys(ctx)
+    backend = ctx.src_db.cache_backend
+    # The cache directory may be shared with the configurations of other
+    # source databases
+    prefix = ctx.src_db.cache_namespace + "/"
+    unreachable_entries = [
+        entry
+        for entry in backend.stats()
+        if entry["name"].startswith(prefix) and entry["key"] not in reachable_keys
+    ]
+    for entry in unreachable_entries:
+        backend.remove(entry["name"])
+    reclaimed = sum(entry["size"] for entry in unreachable_entries)
+    ctx.log(
+        " ---> Purged %d unreachable cache entries (%.1f MB reclaimed)"
+        % (len(unreachable_entries), reclaimed / (1024 * 1024.0))
+    )
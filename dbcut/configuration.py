@@ -23,6 +23,15 @@ DEFAULT_CONFIG = {
     "default_backref_depth": 2,
     "default_join_depth": 5,
     "global_exclude": [],
+    "insert_mode": "orm",
+    "reflect_mode": "full",
+    "yield_per": 1000,
+    "page_size": None,
+    "shards": "auto",
+    "incremental": None,
+    "memory_budget": 1024,
+    "cache_compression": "zlib",
+    "cache_max_size": None,
 }
 
 
@@ -51,7 +60,7 @@ class Configuration(dict):
 
         if not self["cache"]:
             self["cache"] = None
-        else:
+        elif "://" not in self["cache"]:
             self["cache"] = create_directory(self["cache"])
 
         if self.get("queries", None) is None:
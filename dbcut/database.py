@@ -1,30 +1,39 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import glob
+import hashlib
 import os
 import pickle
 import re
+import sqlite3
 import sys
 import threading
-from contextlib import contextmanager
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 
-from sqlalchemy import MetaData, create_engine, event, func, inspect
+from sqlalchemy import MetaData, create_engine, event, func, inspect, text
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.automap import automap_base, generate_relationship
-from sqlalchemy.schema import conv
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import AddConstraint, Index, UniqueConstraint, conv
 from sqlalchemy.sql.expression import select
 from sqlalchemy.types import Text
 
-from . import VERSION
+from .cache_backends import get_cache_backend
 from .configuration import DEFAULT_CONFIG
 from .models import BaseDeclarativeMeta, BaseModel
 from .query import BaseQuery, QueryProperty
 from .session import SessionProperty
 from .utils import (
     aslist,
+    atomic_path,
     cached_property,
     create_directory,
     generate_valid_index_name,
+    pickle_copy,
     to_unicode,
 )
 
@@ -38,6 +47,85 @@ except ImportError:
 
 _MYSQL_LENGHT_TEXT_INDEX_COLUMN = 128
 
+# Trades the durability of the SQLite destination for the load speed, the
+# whole database is to be reloaded if the load is interrupted anyway
+SQLITE_FAST_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -262144",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE",
+]
+
+# Version of the layout of the cached metadata file, bumped only when it
+# changes. 1: the pickled MetaData, 2: the format version and the MetaData
+METADATA_FORMAT_VERSION = 2
+
+# Queries of the definitions of the columns, constraints and indexes of the
+# tables as (table name, kind, name, definition), hashed into the fingerprint
+# of each table to invalidate the cached metadata
+SCHEMA_FINGERPRINT_QUERIES = {
+    "sqlite": """
+        SELECT tbl_name, type, name, sql FROM sqlite_master
+        WHERE type IN ('table', 'index') AND tbl_name NOT LIKE 'sqlite~_%' ESCAPE '~'
+    """,
+    "postgresql": """
+        SELECT c.table_name, 'column', c.column_name, concat_ws(' ', c.data_type,
+            c.character_maximum_length, c.numeric_precision, c.numeric_scale,
+            c.is_nullable, c.column_default)
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+            ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = current_schema() AND t.table_type = 'BASE TABLE'
+        UNION ALL
+        SELECT cl.relname, 'constraint', co.conname, pg_get_constraintdef(co.oid)
+        FROM pg_constraint co
+        JOIN pg_class cl ON cl.oid = co.conrelid
+        JOIN pg_namespace n ON n.oid = cl.relnamespace
+        WHERE n.nspname = current_schema()
+        UNION ALL
+        SELECT tablename, 'index', indexname, indexdef FROM pg_indexes
+        WHERE schemaname = current_schema()
+    """,
+    "mysql": """
+        SELECT c.TABLE_NAME, 'column', c.COLUMN_NAME, CONCAT_WS(' ', c.COLUMN_TYPE,
+            c.IS_NULLABLE, c.COLUMN_DEFAULT, c.EXTRA)
+        FROM information_schema.COLUMNS c
+        JOIN information_schema.TABLES t
+            ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+        WHERE c.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE'
+        UNION ALL
+        SELECT TABLE_NAME, 'index', INDEX_NAME, CONCAT_WS(' ', SEQ_IN_INDEX,
+            COLUMN_NAME, NON_UNIQUE)
+        FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE()
+        UNION ALL
+        SELECT TABLE_NAME, 'key', CONSTRAINT_NAME, CONCAT_WS(' ', COLUMN_NAME,
+            REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME)
+        FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE()
+    """,
+}
+
+# Queries of the (table name, referred table name) of the foreign keys, the
+# tables reachable from the queries are found without reflecting the schema
+FOREIGN_KEY_GRAPH_QUERIES = {
+    "sqlite": """
+        SELECT m.name, f."table" FROM sqlite_master m
+        JOIN pragma_foreign_key_list(m.name) f WHERE m.type = 'table'
+    """,
+    "postgresql": """
+        SELECT cl.relname, r.relname FROM pg_constraint co
+        JOIN pg_class cl ON cl.oid = co.conrelid
+        JOIN pg_class r ON r.oid = co.confrelid
+        JOIN pg_namespace n ON n.oid = cl.relnamespace
+        WHERE co.contype = 'f' AND n.nspname = current_schema()
+    """,
+    "mysql": """
+        SELECT TABLE_NAME, REFERENCED_TABLE_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+    """,
+}
+
 __all__ = ["Database"]
 
 
@@ -53,11 +141,15 @@ class Database(object):
         self,
         uri=None,
         cache_dir=None,
+        cache_backend=None,
         enable_cache=True,
         session_options=None,
         echo_sql=False,
         echo_stream=None,
         metadata=None,
+        cache_compression=None,
+        cache_max_size=None,
+        reachable_from=None,
     ):
         self.connector = None
         self._reflected = False
@@ -67,11 +159,21 @@ class Database(object):
         self.uri = make_url(uri)
         self.enable_cache = enable_cache
         self.global_cache_dir = cache_dir or DEFAULT_CONFIG["cache"]
+        self._cache_backend = cache_backend
+        self.cache_compression = (
+            cache_compression or DEFAULT_CONFIG["cache_compression"]
+        )
+        self.cache_max_size = cache_max_size
+        # (table name, join_depth, backref_depth, excluded tables) of the
+        # queries, to reflect only the tables they reach
+        self.reachable_from = reachable_from
         self._session_options = dict(session_options or {})
         self._session_options.setdefault("autoflush", False)
         self._session_options.setdefault("autocommit", False)
         self._engine_lock = threading.Lock()
         self._model_class_registry = {}
+        self.statements_counter = Counter()
+        self.memory_connection = None
         self.profiler = SessionProfiler(engine=self.engine)
 
         if self.enable_cache and self.cached_metadata:
@@ -88,21 +190,26 @@ class Database(object):
         self.Model._session = SessionProperty(self)
         self.Model._query = QueryProperty(self)
 
-        event.listen(self.engine, "before_cursor_execute", self._before_custor_execute)
-        event.listen(self.engine, "after_cursor_execute", self._after_custor_execute)
+    @cached_property
+    def cache_namespace(self):
+        """Prefix of the names of the cache entries of the database."""
+        # The database of a SQLite URI may be an absolute file path
+        database = (self.uri.database or "").strip("/")
+        parts = [self.uri.drivername, self.uri.host, database]
+        return "/".join(part for part in parts if part)
 
     @cached_property
     def cache_dir(self):
-        if self.uri.host:
-            db_cache_dir = os.path.join(
-                self.uri.drivername, self.uri.host, self.uri.database
-            )
-        else:
-            db_cache_dir = os.path.join(self.uri.drivername, self.uri.database)
-        _cache_dir = os.path.join(self.global_cache_dir, VERSION, db_cache_dir)
+        _cache_dir = os.path.join(
+            self.global_cache_dir, *self.cache_namespace.split("/")
+        )
         create_directory(_cache_dir)
         return _cache_dir
 
+    @cached_property
+    def cache_backend(self):
+        return get_cache_backend(self._cache_backend or self.global_cache_dir)
+
     def start_profiler(self):
         self.profiler.begin()
 
@@ -131,19 +238,59 @@ class Database(object):
 
     @property
     def cached_metadata(self):
-        _cached_metadata = None
-        if os.path.exists(self.cached_metadata_path):
-            try:
-                with open(os.path.join(self.cached_metadata_path), "rb") as cache_file:
-                    _cached_metadata = pickle.load(file=cache_file)
-            except IOError:
-                pass
-        return _cached_metadata
+        data = self.load_cached_metadata()
+        return None if data is None else data["metadata"]
+
+    def load_cached_metadata(self):
+        """Returns the cached metadata and the fingerprints of its tables,
+        also looked for under the namespace of the previous releases
+        (``<version>/<namespace>``) and rewritten in the current format."""
+        path = self.cached_metadata_path
+        if not os.path.exists(path):
+            path = self.previous_cached_metadata_path
+            if path is None:
+                return None
+        try:
+            with open(path, "rb") as cache_file:
+                data = pickle.load(file=cache_file)
+        except IOError:
+            return None
+        if isinstance(data, MetaData):
+            data = {"format_version": 1, "metadata": data}
+        if data["format_version"] > METADATA_FORMAT_VERSION:
+            return None
+        if path != self.cached_metadata_path or (
+            data["format_version"] < METADATA_FORMAT_VERSION
+        ):
+            self.save_cached_metadata(
+                data["metadata"], data.get("fingerprints"), data.get("partial", False)
+            )
+        return data
+
+    def save_cached_metadata(self, metadata, fingerprints=None, partial=False):
+        data = {
+            "format_version": METADATA_FORMAT_VERSION,
+            "metadata": metadata,
+            "fingerprints": fingerprints,
+            "partial": partial,
+        }
+        with atomic_path(self.cached_metadata_path) as metadata_path:
+            with open(metadata_path, "wb") as cache_file:
+                pickle.dump(data, cache_file)
 
     @property
     def cached_metadata_path(self):
         return os.path.join(self.cache_dir, "metadata.cache")
 
+    @property
+    def previous_cached_metadata_path(self):
+        namespace = glob.escape(os.path.join(*self.cache_namespace.split("/")))
+        pattern = os.path.join(
+            glob.escape(self.global_cache_dir), "*", namespace, "metadata.cache"
+        )
+        paths = sorted(glob.glob(pattern), key=os.path.getmtime)
+        return paths[-1] if paths else None
+
     @property
     def query(self):
         """Proxy for session.query"""
@@ -171,8 +318,25 @@ class Database(object):
             reflect = True
             if bind is None:
                 bind = self.engine
-            if self.enable_cache and self.cached_metadata:
+            partial = self.reachable_from is not None
+            cached = self.load_cached_metadata() if self.enable_cache else None
+            if cached is not None and cached.get("partial") and not partial:
+                # Tables are missing from the cached metadata
+                self.metadata.clear()
+                cached = None
+            fingerprints = None
+            if self.enable_cache:
+                fingerprints = self.schema_fingerprints(bind)
+            if partial:
+                reflect = False
+                self.reflect_reachable_tables(bind, cached, fingerprints)
+            elif cached is not None:
                 reflect = False
+                if fingerprints is not None:
+                    stale_tables = self.get_stale_tables(
+                        cached.get("fingerprints") or {}, fingerprints
+                    )
+                    self.reflect_tables(bind, stale_tables)
 
             self.Model.prepare(
                 bind,
@@ -200,12 +364,139 @@ class Database(object):
                     if mysql_length:
                         index.kwargs["mysql_length"] = mysql_length
 
-            if self.enable_cache and not self.cached_metadata:
-                with open(os.path.join(self.cached_metadata_path), "wb") as cache_file:
-                    pickle.dump(self.metadata, cache_file)
+            if self.enable_cache and (
+                cached is None
+                or cached.get("fingerprints") != fingerprints
+                or set(cached["metadata"].tables) != set(self.tables)
+            ):
+                self.save_cached_metadata(self.metadata, fingerprints, partial)
 
             self._reflected = True
 
+    def schema_fingerprints(self, bind=None):
+        """Returns a hash of the definition of each table of the schema, None
+        when it is not supported by the dialect."""
+        sql = SCHEMA_FINGERPRINT_QUERIES.get(self.dialect)
+        if sql is None:
+            return None
+        try:
+            rows = (bind or self.engine).execute(text(sql)).fetchall()
+        except DBAPIError:
+            return None
+        rows_by_table = defaultdict(list)
+        for row in rows:
+            rows_by_table[row[0]].append(tuple(to_unicode(value) for value in row[1:]))
+        return {
+            table_name: hashlib.sha1(repr(sorted(rows)).encode("utf-8")).hexdigest()
+            for table_name, rows in rows_by_table.items()
+        }
+
+    def get_stale_tables(self, cached_fingerprints, fingerprints):
+        """Returns the names of the tables created, changed or dropped since
+        the metadata was cached, and of the tables referring to them. The
+        tables without a cached fingerprint are stale."""
+        names = set(cached_fingerprints) | set(fingerprints) | set(self.metadata.tables)
+        stale_tables = set(
+            name
+            for name in names
+            if name not in cached_fingerprints
+            or cached_fingerprints[name] != fingerprints.get(name)
+        )
+        for table in self.metadata.tables.values():
+            for foreign_key in table.foreign_keys:
+                if get_referred_table_name(foreign_key) in stale_tables:
+                    stale_tables.add(table.name)
+        return stale_tables
+
+    def reflect_tables(self, bind, table_names, resolve_fks=True):
+        """Reflects again the ``table_names`` tables of the metadata, the
+        dropped ones are removed."""
+        if not table_names:
+            return
+        for name in table_names:
+            if name in self.metadata.tables:
+                self.metadata.remove(self.metadata.tables[name])
+        self.metadata.reflect(
+            bind,
+            only=lambda name, metadata: name in table_names,
+            resolve_fks=resolve_fks,
+        )
+
+    def foreign_key_graph(self, bind=None):
+        """Returns the ``(table name, referred table name)`` of the foreign
+        keys of the schema."""
+        bind = bind or self.engine
+        sql = FOREIGN_KEY_GRAPH_QUERIES.get(self.dialect)
+        if sql is not None:
+            return [tuple(row) for row in bind.execute(text(sql))]
+        inspector = inspect(bind)
+        return [
+            (table_name, foreign_key["referred_table"])
+            for table_name in inspector.get_table_names()
+            for foreign_key in inspector.get_foreign_keys(table_name)
+        ]
+
+    def reachable_tables(self, graph):
+        """Returns the names of the tables reached from the ``reachable_from``
+        tables through at most ``join_depth`` foreign keys and ``backref_depth``
+        reverse foreign keys, without the excluded tables."""
+        referred_tables = defaultdict(set)
+        referring_tables = defaultdict(set)
+        for table_name, referred_table_name in graph:
+            referred_tables[table_name].add(referred_table_name)
+            referring_tables[referred_table_name].add(table_name)
+
+        tables = set()
+        for table_name, join_depth, backref_depth, exclude in self.reachable_from:
+            reached = set([table_name])
+            level = reached
+            depth = 1
+            while level:
+                next_level = set()
+                for name in level:
+                    if join_depth is None or join_depth >= depth:
+                        next_level.update(referred_tables[name])
+                    if backref_depth is None or backref_depth >= depth:
+                        next_level.update(referring_tables[name])
+                level = next_level - reached - set(exclude)
+                reached.update(level)
+                depth += 1
+            tables.update(reached)
+        return tables
+
+    def reflect_reachable_tables(self, bind, cached, fingerprints):
+        """Reflects only the tables reachable from the queries in the metadata,
+        the tables of the cached metadata are reflected again when they have
+        changed, or when they refer to newly reached tables."""
+        graph = self.foreign_key_graph(bind)
+        reachable_tables = self.reachable_tables(graph)
+        for name in set(self.metadata.tables) - reachable_tables:
+            self.metadata.remove(self.metadata.tables[name])
+        stale_tables = reachable_tables - set(self.metadata.tables)
+        if cached is not None:
+            if fingerprints is not None:
+                stale_tables.update(
+                    self.get_stale_tables(
+                        cached.get("fingerprints") or {}, fingerprints
+                    )
+                    & reachable_tables
+                )
+            # Their foreign keys to the new tables were dropped
+            stale_tables.update(
+                table_name
+                for table_name, referred_table_name in graph
+                if table_name in self.metadata.tables
+                and referred_table_name in stale_tables
+            )
+        self.reflect_tables(bind, stale_tables, resolve_fks=False)
+
+        # The tables beyond the reach of the queries are not reflected
+        for table in self.metadata.tables.values():
+            for constraint in list(table.foreign_key_constraints):
+                referred_table_name = get_referred_table_name(constraint.elements[0])
+                if referred_table_name not in self.metadata.tables:
+                    drop_foreign_key_constraint(table, constraint)
+
     def prepare(self, bind=None):
         """Proxy for Model.prepare"""
         if not (self._reflected or self._prepared):
@@ -221,11 +512,53 @@ class Database(object):
                 indexes.append(index)
         return indexes
 
-    def create_all(self, bind=None, **kwargs):
-        """Creates all tables. """
+    def create_all(self, bind=None, defer_indexes=False, **kwargs):
+        """Creates all tables. With ``defer_indexes``, the indexes and unique
+        constraints of the new tables are left out and returned, to be built
+        with ``create_indexes`` once the tables are loaded. """
         if bind is None:
             bind = self.engine
-        self.metadata.create_all(bind=bind, **kwargs)
+        if not defer_indexes:
+            self.metadata.create_all(bind=bind, **kwargs)
+            return []
+
+        existing_tables = set(inspect(bind).get_table_names())
+        deferred = []
+        for table in self.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                deferred.extend(table.indexes)
+                deferred.extend(get_unique_constraints(table))
+
+        metadata = pickle_copy(self.metadata)
+        for table in metadata.tables.values():
+            table.indexes.clear()
+            for constraint in get_unique_constraints(table):
+                table.constraints.remove(constraint)
+        metadata.create_all(bind=bind, **kwargs)
+        return deferred
+
+    def create_indexes(self, items, jobs=1):
+        """Creates the given indexes and unique constraints, with ``jobs``
+        concurrent connections on the dialects allowing it. """
+
+        def create(item):
+            if isinstance(item, UniqueConstraint):
+                if self.dialect == "sqlite":
+                    # SQLite cannot add a constraint to an existing table
+                    item = Index(None, *item.columns, unique=True)
+                    item.name = conv(generate_valid_index_name(item, self.dialect))
+                else:
+                    with self.engine.begin() as con:
+                        con.execute(AddConstraint(item))
+                    return
+            item.create(bind=self.engine)
+
+        if self.dialect == "sqlite" or jobs <= 1:
+            for item in items:
+                create(item)
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                list(executor.map(create, items))
 
     def drop_all(self, checkfirst=True):
         """Proxy for metadata.drop_all"""
@@ -309,6 +642,93 @@ class Database(object):
             session.close()
             scoped_session.remove()
 
+    @contextmanager
+    def sqlite_fast_load(self):
+        """ A context manager that applies the fast-load PRAGMAs to all the
+        connections opened to the SQLite database, then restores the safe
+        settings and analyzes the loaded tables. """
+        with self.engine.connect() as con:
+            journal_mode = con.execute("PRAGMA journal_mode").scalar()
+
+        def set_fast_load_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in SQLITE_FAST_LOAD_PRAGMAS:
+                cursor.execute(pragma)
+            cursor.close()
+
+        # The file databases connections are not pooled, each session
+        # transaction opens a new connection
+        event.listen(self.engine, "connect", set_fast_load_pragmas)
+        try:
+            yield
+        finally:
+            event.remove(self.engine, "connect", set_fast_load_pragmas)
+            with self.engine.connect() as con:
+                con.execute("PRAGMA locking_mode = NORMAL")
+                con.execute("PRAGMA synchronous = FULL")
+                con.execute("PRAGMA journal_mode = %s" % journal_mode)
+                con.execute("ANALYZE")
+
+    @contextmanager
+    def sqlite_in_memory(self):
+        """ A context manager that moves the SQLite database in memory: the
+        existing database file is copied in memory, all the connections go to
+        the in-memory database, which is written back to the file in one
+        sequential write with the online backup API. """
+        path = self.uri.database
+        memory_connection = sqlite3.connect(":memory:", check_same_thread=False)
+        if os.path.exists(path):
+            with closing(sqlite3.connect(path)) as file_connection:
+                file_connection.backup(memory_connection)
+
+        self.close()
+        self.memory_connection = memory_connection
+        self.profiler = SessionProfiler(engine=self.engine)
+        try:
+            yield
+            with closing(sqlite3.connect(path)) as file_connection:
+                memory_connection.backup(file_connection)
+        finally:
+            self.close()
+            self.memory_connection = None
+            self.profiler = SessionProfiler(engine=self.engine)
+            memory_connection.close()
+
+    @aslist
+    def estimate_table_sizes(self):
+        """ Yields the name, number of rows and size in bytes (with the
+        indexes) of the tables, estimated from the database statistics. """
+        sizes = {}
+        with self.engine.connect() as con:
+            if self.dialect == "postgresql":
+                rows = con.execute(
+                    "SELECT c.relname, pg_total_relation_size(c.oid) FROM pg_class c"
+                    " JOIN pg_namespace n ON n.oid = c.relnamespace"
+                    " WHERE c.relkind = 'r' AND n.nspname = current_schema()"
+                )
+                sizes = dict(rows.fetchall())
+            elif self.dialect == "mysql":
+                rows = con.execute(
+                    "SELECT table_name, data_length + index_length"
+                    " FROM information_schema.tables WHERE table_schema = %s",
+                    (self.engine.url.database,),
+                )
+                sizes = dict(rows.fetchall())
+        counts = dict(self.count_all(estimate=True))
+        if self.dialect == "sqlite":
+            # The table sizes are not known without the optional dbstat table,
+            # the file size is shared between the tables by number of rows
+            with self.engine.connect() as con:
+                page_size = con.execute("PRAGMA page_size").scalar()
+                page_count = con.execute("PRAGMA page_count").scalar()
+            total_rows = sum(counts.values()) or 1
+            sizes = {
+                name: page_size * page_count * rows // total_rows
+                for name, rows in counts.items()
+            }
+        for name, rows in counts.items():
+            yield name, rows, int(sizes.get(name) or 0)
+
     def show(self):
         """ Return small database content representation."""
         for model_name in sorted(self.models.keys()):
@@ -387,6 +807,9 @@ class Database(object):
     def _before_custor_execute(
         self, conn, cursor, statement, parameters, context, executemany
     ):
+        words = statement.split(None, 1)
+        if words:
+            self.statements_counter[words[0].upper()] += 1
         if self.echo_sql:
             if conn.engine.dialect.name == "sqlite":
                 conn.connection.connection.set_trace_callback(
@@ -424,6 +847,24 @@ class Database(object):
         return "<%s engine=%r>" % (self.__class__.__name__, engine)
 
 
+def get_unique_constraints(table):
+    return [c for c in table.constraints if isinstance(c, UniqueConstraint)]
+
+
+def get_referred_table_name(foreign_key):
+    # The target is "[schema.]table.column"
+    return foreign_key.target_fullname.rsplit(".", 2)[-2]
+
+
+def drop_foreign_key_constraint(table, constraint):
+    table.constraints.discard(constraint)
+    for foreign_key in constraint.elements:
+        # Otherwise linked to the referred table once it is reflected
+        foreign_key._remove_from_metadata(table.metadata)
+        foreign_key.parent.foreign_keys.discard(foreign_key)
+        table.foreign_keys.discard(foreign_key)
+
+
 class EngineConnector(object):
     def __init__(self, db, connect_timeout=3):
         self._db = db
@@ -457,6 +898,13 @@ class EngineConnector(object):
                     elif info.drivername == "postgresql":
                         options.setdefault("use_batch_mode", True)
 
+                elif info.drivername == "sqlite" and self._db.memory_connection:
+                    # All the connections share the in-memory database
+                    memory_connection = self._db.memory_connection
+                    options["creator"] = lambda: memory_connection
+                    options["poolclass"] = StaticPool
+                    info = make_url("sqlite://")
+
                 elif info.drivername == "sqlite":
                     no_pool = options.get("pool_size") == 0
                     memory_based = info.database in (None, "", ":memory:")
@@ -465,7 +913,19 @@ class EngineConnector(object):
                             "SQLite in-memory database with an empty queue"
                             " (pool_size = 0) is not possible due to data loss."
                         )
+                    if not memory_based:
+                        # Streamed results may be consumed from the pipeline
+                        # thread, never concurrently with the calling thread
+                        options["connect_args"] = {"check_same_thread": False}
 
                 self._engine = create_engine(info, **options)
                 self._engine._db = self._db
+                event.listen(
+                    self._engine,
+                    "before_cursor_execute",
+                    self._db._before_custor_execute,
+                )
+                event.listen(
+                    self._engine, "after_cursor_execute", self._db._after_custor_execute
+                )
             return self._engine
@@ -11,3 +11,7 @@ class UndefinedError(Exception):
     @property
     def message(self):
         return "%r is undefined" % self.keyname
+
+
+class CorruptedCacheError(Exception):
+    pass
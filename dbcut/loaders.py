@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, deque
+
+from sqlalchemy import inspect
+
+from .bulk import bulk_insert
+
+__all__ = ["INSERT_MODES", "OrmLoader", "BulkLoader", "NativeLoader", "get_loader"]
+
+
+class BaseLoader(object):
+    """Inserts rows grouped by table (like the cached rows) with Core
+    executemany statements, table by table."""
+
+    def __init__(self, session):
+        self.session = session
+        self.inserted = 0
+
+    def load_rows(self, rows_by_table):
+        for table in self.session.db.metadata.sorted_tables:
+            rows = rows_by_table.get(table.name)
+            if rows:
+                self.insert_rows(table, rows)
+                self.inserted += len(rows)
+        self.session.commit()
+
+    def insert_rows(self, table, rows):
+        self.session.execute(table.insert(), rows)
+
+
+class OrmLoader(BaseLoader):
+    """Inserts objects through the SQLAlchemy unit of work."""
+
+    def load(self, objects):
+        self.session.add_all(objects)
+        self.inserted += len(list(self.session))
+        self.session.commit()
+        # Release the inserted objects so that memory stays bounded
+        self.session.expunge_all()
+
+
+class BulkLoader(BaseLoader):
+    """Inserts objects rows with Core executemany statements, table by table,
+    without going through the ORM flush process.
+    """
+
+    def __init__(self, session):
+        super(BulkLoader, self).__init__(session)
+        self._seen = set()
+
+    def load(self, objects):
+        self.load_rows(extract_rows(objects, seen=self._seen))
+
+
+class NativeLoader(BulkLoader):
+    """Inserts objects rows with the native bulk load of the destination
+    database: COPY for PostgreSQL, LOAD DATA for MySQL and a DBAPI executemany
+    for SQLite.
+    """
+
+    def insert_rows(self, table, rows):
+        bulk_insert(self.session.connection(), table, rows)
+
+
+INSERT_MODES = OrderedDict(
+    [("orm", OrmLoader), ("bulk", BulkLoader), ("native", NativeLoader)]
+)
+
+
+def get_loader(insert_mode, session):
+    try:
+        loader_class = INSERT_MODES[insert_mode]
+    except KeyError:
+        raise ValueError(
+            "Unknown insert mode %r (expected one of: %s)"
+            % (insert_mode, ", ".join(INSERT_MODES))
+        )
+    return loader_class(session)
+
+
+def get_column_keys(mapper):
+    """Returns the (column name, attribute key) pairs of the mapper table."""
+    return [
+        (column.name, mapper.get_property_by_column(column).key)
+        for column in mapper.local_table.columns
+    ]
+
+
+def extract_rows(objects, seen=None, states_by_table=None):
+    """Walks the loaded object graph and returns the rows to insert grouped by
+    table name. Each row is only returned once, ``seen`` keeps track of the
+    already extracted rows between calls. The instance states of the rows are
+    added to ``states_by_table`` when given.
+    """
+    seen = set() if seen is None else seen
+    columns_by_mapper = {}
+    rows_by_table = {}
+    queue = deque(objects)
+    while queue:
+        state = inspect(queue.popleft())
+        mapper = state.mapper
+        values = state.dict
+
+        if mapper not in columns_by_mapper:
+            columns_by_mapper[mapper] = get_column_keys(mapper)
+        row = {name: values.get(key) for name, key in columns_by_mapper[mapper]}
+
+        table_name = mapper.local_table.name
+        primary_key = tuple(row[c.name] for c in mapper.local_table.primary_key)
+        if not primary_key or None in primary_key:
+            primary_key = (id(state),)
+        identity = (table_name,) + primary_key
+        if identity in seen:
+            continue
+        seen.add(identity)
+        rows_by_table.setdefault(table_name, []).append(row)
+        if states_by_table is not None:
+            states_by_table.setdefault(table_name, []).append(state)
+
+        for relationship in mapper.relationships:
+            if relationship.key not in values:
+                continue
+            value = values[relationship.key]
+            if relationship.uselist:
+                queue.extend(value)
+            elif value is not None:
+                queue.append(value)
+    return rows_by_table
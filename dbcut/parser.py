@@ -114,6 +114,9 @@ uncache_module(
 )
 
 
+FETCH_OPTIONS = ["yield_per", "page_size", "shards", "incremental"]
+
+
 def parse_query(qd, session, config):
     """Parses the given query dictionary to produce a BaseQuery object.
     """
@@ -129,6 +132,10 @@ def parse_query(qd, session, config):
     }
     qd.setdefault("limit", defaults["limit"])
 
+    # Fetch options change how rows are fetched, not which rows are fetched,
+    # so they are not part of the query_dict (and of the cache key)
+    fetch_options = {key: qd.pop(key, config[key]) for key in FETCH_OPTIONS}
+
     full_qd = merge_dicts(defaults, qd)
 
     if qd["limit"] in (None, False):
@@ -145,6 +152,7 @@ def parse_query(qd, session, config):
     mlquery = mlalchemy_parse_query(qd)
 
     query = mlquery.to_query(session, session.bind._db.models)
+    query.fetch_options = fetch_options
 
     order_by = full_qd.pop("order-by", None)
     if order_by:
@@ -183,3 +191,19 @@ def parse_query(qd, session, config):
     query = mlquery.apply_filters(query)
 
     return query
+
+
+def get_query_reach(qd, config):
+    """Returns the table of the given query dictionary, how deep its relations
+    are loaded (``join_depth`` and ``backref_depth``, None when unlimited) and
+    its excluded tables, as ``parse_query`` does."""
+    include = qd.get("include") or []
+    exclude = qd.get("exclude") or []
+    if isinstance(exclude, str):
+        exclude = [exclude]
+    exclude = list(set(exclude + config["global_exclude"]))
+    if include:
+        return qd["from"], None, None, exclude
+    join_depth = qd.get("join_depth", config["default_join_depth"]) or 0
+    backref_depth = qd.get("backref_depth", config["default_backref_depth"]) or 0
+    return qd["from"], join_depth, backref_depth, exclude
@@ -1,35 +1,62 @@
 # -*- coding: utf-8 -*-
+import base64
 import hashlib
 import os
+import pickle
+from itertools import chain
 from pickle import PicklingError
-from weakref import WeakSet
 
 import yaml
 from pptree import print_tree
-from sqlalchemy import event
-from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy import and_, event, func, inspect, or_
 from sqlalchemy.orm import Query, class_mapper, interfaces, joinedload, selectinload
+from sqlalchemy.orm.attributes import instance_dict, set_committed_value
 from sqlalchemy.orm.exc import UnmappedClassError
+from sqlalchemy.orm.interfaces import MapperOption
 from sqlalchemy.orm.query import Bundle
 from sqlalchemy.orm.session import make_transient, object_session
-
-from .serializer import dump_json, load_json, to_json
-from .utils import aslist, cached_property, redirect_stdout, sorted_nested_dict
-
-VISITED_QUERIES = WeakSet()
+from sqlalchemy.orm.strategies import SelectInLoader
+from sqlalchemy.sql import operators
+
+from .cache import CacheReader, CacheWriter, LegacyCacheReader, is_rows_cache
+from .exceptions import CorruptedCacheError
+from .serializer import dump_json_list, to_json
+from .utils import (
+    ParallelIterator,
+    aslist,
+    cached_property,
+    chunks,
+    redirect_stdout,
+    sorted_nested_dict,
+)
+
+# MySQL is excluded as its unbuffered cursors do not allow the "selectin"
+# queries to run while the main result is being fetched.
+STREAMING_DIALECTS = ("postgresql", "sqlite")
+
+# With ``shards: auto``, a query is split in one shard per AUTO_SHARD_ROWS
+# primary keys, up to MAX_AUTO_SHARDS shards.
+AUTO_SHARD_ROWS = 100000
+MAX_AUTO_SHARDS = 4
+
+# Query options which only bound the result: the cached result of a query with
+# larger bounds contains the result of the query.
+SUBSUMED_KEYS = ("limit", "backref_limit")
 
 
 class BaseQuery(Query):
 
     query_dict = None
+    fetch_options = None
     relation_tree = None
+    loader_backref_limit = None
+    _cache_lock = None
 
     def __init__(self, *args, **kwargs):
         super(BaseQuery, self).__init__(*args, **kwargs)
         event.listen(
             self, "before_compile", self._apply_backref_collection_limit, retval=True
         )
-        VISITED_QUERIES.add(self)
 
     class QueryStr(str):
         # Useful for debug
@@ -63,13 +90,10 @@ class BaseQuery(Query):
         ).hexdigest()
 
     @property
-    def cache_basename(self):
-        basename = "{}-{}".format(self.model_class.__name__, self.cache_key)
-        return os.path.join(self.session.db.cache_dir, basename)
-
-    @property
-    def cache_file(self):
-        return "{}.cache".format(self.cache_basename)
+    def cache_name(self):
+        return "{}/{}-{}".format(
+            self.session.db.cache_namespace, self.model_class.__name__, self.cache_key
+        )
 
     @property
     def json_file(self):
@@ -77,14 +101,15 @@ class BaseQuery(Query):
         return os.path.abspath(os.path.join(os.getcwd(), "{}.json".format(basename)))
 
     @property
-    def count_cache_file(self):
-        return "{}.count".format(self.cache_basename)
+    def cache_backend(self):
+        return self.session.db.cache_backend
 
     @property
     def is_cached(self):
         if self.query_dict is not None:
-            return os.path.isfile(self.cache_file) and os.path.isfile(
-                self.count_cache_file
+            return (
+                self.cache_backend.exists(self.cache_name)
+                or self.adopt_previous_entry()
             )
         return False
 
@@ -92,33 +117,411 @@ class BaseQuery(Query):
     def model_class(self):
         return self.session.db.models[self._bind_mapper().class_.__name__]
 
+    def cache_writer(self):
+        return QueryCacheWriter(self)
+
     def save_to_cache(self, objects=None):
         if objects is None:
-            objects = list(self.objects())
-        try:
-            content = sa_serializer.dumps(objects)
-            with open(self.cache_file, "wb") as fd:
-                fd.write(content)
-            count_data = {"count": len(objects)}
-            dump_json(count_data, self.count_cache_file)
-        except PicklingError:
-            pass
+            objects = self.objects()
+        with self.cache_writer() as writer:
+            writer.write(objects)
 
     def export_to_json(self, objects=None):
         if objects is None:
-            objects = list(self.objects())
-        dump_json(objects, self.json_file)
+            objects = self.objects()
+        dump_json_list(objects, self.json_file)
+
+    def load_from_cache(self, session=None, name=None):
+        """Returns the number of cached objects and an iterator over the
+        cached chunks of rows, decoded one by one from the cache entry of the
+        query (or from the entry ``name``).
 
-    def load_from_cache(self, session=None):
+        The checksum of the entry is verified first, a corrupted cache entry
+        is removed and raises ``CorruptedCacheError``.
+        """
         session = session or self.session
+        name = name or self.cache_name
+        info = self.cache_backend.info(name)
+        cache_file = None
+        if info is not None:
+            cache_file = self.cache_backend.stream(name)
+        if cache_file is not None and not is_rows_cache(cache_file):
+            if name == self.cache_name:
+                with cache_file:
+                    self.migrate_legacy_cache(cache_file, session)
+                cache_file = self.cache_backend.stream(name)
+        if cache_file is None:
+            raise CorruptedCacheError("Incomplete cache entry %s" % name)
+
+        try:
+            reader = CacheReader(cache_file)
+            reader.verify()
+            if reader.is_outdated and name == self.cache_name:
+                with cache_file:
+                    self.migrate_cache_format(reader, info)
+                cache_file = self.cache_backend.stream(name)
+                reader = CacheReader(cache_file)
+        except CorruptedCacheError:
+            cache_file.close()
+            self.cache_backend.remove(name)
+            raise
+        return info["count"], iter_cache_chunks(reader, cache_file)
+
+    def migrate_legacy_cache(self, legacy_file, session):
+        """Rewrites a cache entry of the legacy format in the row format."""
         metadata = session.db.metadata
-        count = load_json(self.count_cache_file)["count"]
+        with self.cache_writer() as writer:
+            for group in LegacyCacheReader(legacy_file, metadata, session):
+                writer.write(group)
+
+    def migrate_cache_format(self, reader, info):
+        """Rewrites a cache entry of a previous format version in the current
+        format, keeping its info."""
+        backend = self.cache_backend
+        fd, temp_file = backend.mkstemp(self.cache_name)
+        try:
+            with os.fdopen(fd, "wb") as temp_fd:
+                writer = CacheWriter(temp_fd, self.session.db, codec=reader.codec)
+                for chunk in reader:
+                    writer.write_chunk(chunk)
+                writer.close()
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        backend.put(self.cache_name, temp_file, info)
+
+    def adopt_previous_entry(self):
+        """Moves the cache entry of the query written under the namespace of
+        a previous dbcut release (``<version>/<namespace>/...``) to its
+        current name. Returns whether there was such an entry."""
+        backend = self.cache_backend
+        names = backend.prefixed_names(self.cache_name)
+        if not names:
+            return False
+        return backend.move(names[-1], self.cache_name)
+
+    def remove_from_cache(self):
+        self.cache_backend.remove(self.cache_name)
+
+    def lock_cache(self):
+        """Waits for the other processes writing the cache entry of the query
+        and locks it, until ``unlock_cache``."""
+        if self._cache_lock is None:
+            self._cache_lock = self.cache_backend.lock(self.cache_name)
+            self._cache_lock.acquire()
+
+    def unlock_cache(self):
+        if self._cache_lock is not None:
+            self._cache_lock.release()
+            self._cache_lock = None
+
+    @cached_property
+    def shape_key(self):
+        """Hash of the query without its limits: the cached result of a query
+        of the same shape and of larger limits contains the result of this
+        one."""
+        query_info = {
+            key: value
+            for key, value in self.query_dict.items()
+            if key not in SUBSUMED_KEYS
+        }
+        info = dict(self.info, query_info=query_info)
+        return hashlib.sha1(
+            to_json(sorted_nested_dict(info)).encode("utf-8")
+        ).hexdigest()
 
-        with open(self.cache_file, "rb") as fd:
-            return count, sa_serializer.loads(fd.read(), metadata, session)
+    @property
+    def backref_limit(self):
+        return (self.query_dict or {}).get("backref_limit") or None
+
+    def find_superset_entry(self):
+        """Returns the name and the info of the smallest cache entry of the
+        same shape and of larger or equal limits, None when there is none.
+
+        Only the results of limited queries are used, as they are cached in
+        the order of the query. The collections of a larger result must not be
+        limited, unless the result holds the same objects.
+        """
+        if self.query_dict is None or self._limit is None:
+            return None
+        candidates = []
+        prefix = self.cache_name[: -len(self.cache_key)]
+        for entry in self.cache_backend.stats():
+            if not entry["name"].startswith(prefix):
+                continue
+            info = self.cache_backend.info(entry["name"])
+            if not info or info.get("shape") != self.shape_key:
+                continue
+            if info["limit"] is None or info["limit"] < self._limit:
+                continue
+            if info["backref_limit"] is not None and (
+                info["limit"] != self._limit
+                or self.backref_limit is None
+                or info["backref_limit"] < self.backref_limit
+            ):
+                # The backref limit applies to the collections of all the
+                # objects of a result, it is only subsumed for the same objects
+                continue
+            candidates.append((info["limit"], entry["name"], info))
+        if not candidates:
+            return None
+        limit, name, info = min(candidates, key=lambda candidate: candidate[:2])
+        return name, info
+
+    def subsumed_groups(self, session=None):
+        """Derives the result of the query from a cached result of the same
+        shape and of larger limits: its first ``limit`` objects, with the
+        backref collections cut to the ``backref_limit`` of the query. Returns
+        the number of objects and their groups, None when no cached result
+        contains the result of the query.
+        """
+        superset = self.find_superset_entry()
+        if superset is None:
+            return None
+        name, info = superset
+        count, cached_chunks = self.load_from_cache(session=session, name=name)
+        backref_limit = None
+        if info["backref_limit"] != self.backref_limit:
+            backref_limit = self.backref_limit
+        groups = self.limited_groups(cached_chunks, backref_limit)
+        return min(count, self._limit), groups
+
+    def limited_groups(self, cached_chunks, backref_limit=None):
+        remaining = self._limit
+        try:
+            for chunk in cached_chunks:
+                group = chunk.to_objects(self.session.db)[:remaining]
+                remaining -= len(group)
+                if backref_limit is not None:
+                    limit_backref_collections(group, backref_limit)
+                if group:
+                    yield group
+                if remaining == 0:
+                    break
+        finally:
+            cached_chunks.close()
+
+    @property
+    def incremental_column(self):
+        """The column declared by the ``incremental`` fetch option, None when
+        the query is not refreshed incrementally."""
+        name = (self.fetch_options or {}).get("incremental")
+        if not name:
+            return None
+        table = self._bind_mapper().local_table
+        if name not in table.c:
+            raise ValueError("Unknown incremental column %r of %s" % (name, table))
+        return table.c[name]
+
+    def incremental_merge_order(self):
+        """Tells where the rows beyond the high-water mark go in the cached
+        result: "first" or "last". None is returned when the result of a
+        limited query is not ordered by the incremental column alone, as the
+        new rows could not be merged in it.
+        """
+        column = self.incremental_column
+        if column is None or self._offset is not None:
+            return None
+        order_by = list(self._order_by or [])
+        ascending = None
+        if len(order_by) == 1:
+            clause = order_by[0]
+            if getattr(clause, "element", clause).shares_lineage(column):
+                ascending = getattr(clause, "modifier", None) is not operators.desc_op
+        if self._limit is not None and ascending is None:
+            return None
+        return "last" if ascending else "first"
+
+    def refreshed_groups(self, session=None):
+        """Fetches the rows beyond the high-water mark of the cache entry and
+        returns the estimated number of objects and their groups merged into
+        the cached ones: the cached objects fetched again (updated rows) are
+        replaced and the query limit is applied. None is returned when the
+        query can not be refreshed incrementally.
+        """
+        merge_order = self.incremental_merge_order()
+        info = self.cache_backend.info(self.cache_name) or {}
+        column = self.incremental_column
+        if merge_order is None or info.get("incremental") != column.name:
+            return None
+        high_water_mark = decode_high_water_mark(info["high_water_mark"])
+        query = self.limit(None).filter(column > high_water_mark).limit(self._limit)
+        new_groups = list(query.object_groups())
+        count, cached_chunks = self.load_from_cache(session=session)
+        count += sum(len(group) for group in new_groups)
+        if self._limit is not None:
+            count = min(count, self._limit)
+        groups = self.merged_groups(new_groups, cached_chunks, merge_order)
+        return count, groups
+
+    def merged_groups(self, new_groups, cached_chunks, merge_order):
+        mapper = self._bind_mapper()
+        new_keys = set(
+            tuple(mapper.primary_key_from_instance(obj))
+            for group in new_groups
+            for obj in group
+        )
+        cached_groups = (
+            [
+                obj
+                for obj in chunk.to_objects(self.session.db)
+                if tuple(mapper.primary_key_from_instance(obj)) not in new_keys
+            ]
+            for chunk in cached_chunks
+        )
+        if merge_order == "first":
+            groups = chain(new_groups, cached_groups)
+        else:
+            groups = chain(cached_groups, new_groups)
+
+        remaining = self._limit
+        try:
+            for group in groups:
+                if remaining is not None:
+                    group = group[:remaining]
+                    remaining -= len(group)
+                if group:
+                    yield group
+                if remaining == 0:
+                    break
+        finally:
+            # Releases the cache file when the limit is reached
+            cached_chunks.close()
 
     def objects(self, session=None):
-        yield from self.transient_objects()
+        for group in self.object_groups():
+            yield from group
+
+    def object_groups(self):
+        """Yields the objects by lists of objects sharing the same instances
+        of their related rows: each fetch of a streamed query, each keyset
+        page and each shard loads its own instances.
+        """
+        shard_ranges = self.shard_ranges()
+        if shard_ranges:
+            yield from self.sharded_groups(shard_ranges)
+        elif self.page_size:
+            yield from self.keyset_groups()
+        else:
+            yield from self.fetched_groups(self)
+
+    @property
+    def is_splittable(self):
+        """Only the unlimited queries ordered by primary key can be split in
+        several statements on their primary key."""
+        return (
+            self._limit is None
+            and self._offset is None
+            and not self._group_by
+            and "order_by" not in (self.query_dict or {})
+            and len(self._bind_mapper().primary_key) > 0
+        )
+
+    @property
+    def page_size(self):
+        """Number of rows of each keyset page when the query is paginated,
+        None when the query is fetched with a single statement."""
+        page_size = (self.fetch_options or {}).get("page_size")
+        if page_size and self.is_splittable:
+            # A page is made of whole fetches and "selectin" loader chunks
+            unit = self.fetch_size or SelectInLoader._chunksize
+            return -(-page_size // unit) * unit
+
+    def keyset_groups(self):
+        """Fetches the objects page by page, each page starting after the
+        primary key of the last object of the previous page, so that no
+        statement nor transaction stays open on the source during the whole
+        extraction.
+        """
+        mapper = self._bind_mapper()
+        page_size = self.page_size
+        page = self
+        while True:
+            count = 0
+            for group in self.fetched_groups(page.limit(page_size)):
+                count += len(group)
+                yield group
+            # Releases the source connection between two pages
+            self.session.close()
+            if count < page_size:
+                return
+            last_key = mapper.primary_key_from_instance(group[-1])
+            page = self.filter(keyset_criterion(mapper.primary_key, last_key))
+
+    def shard_ranges(self):
+        """Splits the integer primary key range of the query in ``shards``
+        ranges of the same width, from the highest one. An empty list is
+        returned when the query is not sharded.
+        """
+        shards = (self.fetch_options or {}).get("shards")
+        mapper = self._bind_mapper()
+        if not shards or not self.is_splittable or len(mapper.primary_key) != 1:
+            return []
+        column = mapper.primary_key[0]
+        try:
+            if not issubclass(column.type.python_type, int):
+                return []
+        except NotImplementedError:
+            return []
+
+        bounds_query = self.with_entities(func.min(column), func.max(column))
+        low, high = bounds_query.order_by(None).one()
+        if low is None:
+            return []
+        width = high - low + 1
+        if shards == "auto":
+            # The primary key range is used as an estimate of the row count
+            shards = min(-(-width // AUTO_SHARD_ROWS), MAX_AUTO_SHARDS)
+        shards = min(shards, width)
+        if shards <= 1:
+            return []
+        bounds = [low + width * i // shards for i in range(shards + 1)]
+        return [(bounds[i], bounds[i + 1] - 1) for i in reversed(range(shards))]
+
+    def sharded_groups(self, shard_ranges):
+        """Fetches the shards in parallel, each one from its own session and
+        connection, and yields their groups of objects as they come.
+        """
+        column = self._bind_mapper().primary_key[0]
+        shards = []
+        for low, high in shard_ranges:
+            shard = self.filter(column.between(low, high))
+            shard.fetch_options = dict(self.fetch_options, shards=None)
+            shards.append(shard.shard_groups())
+        yield from ParallelIterator(shards, maxsize=len(shards))
+
+    def shard_groups(self):
+        """Fetches the query from a session of the calling thread."""
+        scoped_session = self.session.db.session
+        shard = self.with_session(scoped_session())
+        try:
+            yield from shard.object_groups()
+        finally:
+            scoped_session.remove()
+
+    def fetched_groups(self, query):
+        """Yields the objects of ``query`` by groups of ``fetch_size``."""
+        objects = self.transient_objects(query.streamed())
+        yield from chunks(objects, query.fetch_size)
+
+    @property
+    def fetch_size(self):
+        """Number of rows fetched at once when the query is streamed, None
+        when all the rows are fetched at once."""
+        yield_per = (self.fetch_options or {}).get("yield_per")
+        if yield_per and self.session.db.dialect in STREAMING_DIALECTS:
+            # Align the fetches on the "selectin" loader chunks so that the
+            # backref_limit applies to the same groups of parents
+            chunksize = SelectInLoader._chunksize
+            return -(-yield_per // chunksize) * chunksize
+
+    def streamed(self):
+        """Returns a query fetching rows by batches of ``fetch_size`` through a
+        server-side cursor (PostgreSQL) or incremental fetches (SQLite).
+        """
+        if self.fetch_size:
+            return self.yield_per(self.fetch_size)
+        return self
 
     def transient_objects(self, objects=None, session=None):
         if objects is None:
@@ -126,8 +529,9 @@ class BaseQuery(Query):
         for obj in objects:
             if session is None:
                 session = object_session(obj)
-            for instance in session or []:
-                make_transient(instance)
+            # Only the instances loaded since the last call are in the session
+            if session is not None and len(session.identity_map):
+                make_transient_all(session)
             yield obj
 
     def with_loaded_relations(
@@ -214,6 +618,8 @@ class BaseQuery(Query):
                 query = query.group_by(query.model_class)
 
         query.relation_tree = root_node
+        if self.backref_limit is not None:
+            query = query.options(BackrefLimitOption(self.backref_limit))
 
         for relationship, path, weight in sorted(relations_to_load, key=lambda x: x[1]):
             if relationship.direction is interfaces.ONETOMANY:
@@ -224,11 +630,10 @@ class BaseQuery(Query):
         return query
 
     def _apply_backref_collection_limit(self, query):
-        def query_with_limit(query):
-            for visited_query in VISITED_QUERIES:
-                query_dict = getattr(visited_query, "query_dict", None)
-                if query_dict is not None:
-                    return query.limit(query_dict.get("backref_limit", None) or None)
+        # The limit comes with the options of the query which loads the
+        # parents, whatever the thread in which the collections are loaded
+        backref_limit = query.loader_backref_limit
+        if backref_limit is None:
             return query
 
         if query._attributes:
@@ -237,9 +642,7 @@ class BaseQuery(Query):
                     key = keyattr[0]
                     if key == "orig_query":
                         # this is a sub query
-                        orig_query = query._attributes[keyattr]
-                        if orig_query.query_dict:
-                            return query_with_limit(query)
+                        return query.limit(backref_limit)
             for desc in query.column_descriptions:
                 if (
                     desc["entity"] is None
@@ -247,10 +650,105 @@ class BaseQuery(Query):
                     and desc["type"] == Bundle
                 ):
                     # this is a selectin query
-                    return query_with_limit(query)
+                    return query.limit(backref_limit)
         return query
 
 
+class BackrefLimitOption(MapperOption):
+    """Carries the ``backref_limit`` of a query to the queries loading its
+    related collections."""
+
+    propagate_to_loaders = True
+
+    def __init__(self, backref_limit):
+        self.backref_limit = backref_limit
+
+    def process_query(self, query):
+        query.loader_backref_limit = self.backref_limit
+
+    def _generate_cache_key(self, path):
+        return (("backref_limit", self.backref_limit),)
+
+
+class QueryCacheWriter(object):
+    """Writes the rows of the query objects to the cache chunk by chunk.
+
+    The chunks are written to a temporary file given to the cache backend
+    once all of them have been successfully pickled, so a partially written
+    cache is never considered as valid.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.count = 0
+        self.failed = False
+        self.evicted = []
+        self.size = 0
+        self.high_water_mark = None
+        self._fd = None
+        self._writer = None
+        self._temp_file = None
+        self._incremental_key = None
+        column = query.incremental_column
+        if column is not None:
+            mapper = query._bind_mapper()
+            self._incremental_key = mapper.get_property_by_column(column).key
+
+    def __enter__(self):
+        backend = self.query.cache_backend
+        fd, self._temp_file = backend.mkstemp(self.query.cache_name)
+        self._fd = os.fdopen(fd, "wb")
+        db = self.query.session.db
+        self._writer = CacheWriter(self._fd, db, codec=db.cache_compression)
+        return self
+
+    def write(self, objects):
+        if self.failed:
+            return
+        try:
+            self.count += self._writer.write(objects)
+        except PicklingError:
+            self.failed = True
+            return
+        if self._incremental_key is not None:
+            values = [instance_dict(obj).get(self._incremental_key) for obj in objects]
+            values = [v for v in values if v is not None]
+            if self.high_water_mark is not None:
+                values.append(self.high_water_mark)
+            if values:
+                self.high_water_mark = max(values)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        query = self.query
+        failed = exc_type is not None or self.failed
+        try:
+            if not failed:
+                self._writer.close()
+        finally:
+            self._fd.close()
+        if failed:
+            os.remove(self._temp_file)
+            return
+
+        self.size = os.path.getsize(self._temp_file)
+        info = {"count": self.count}
+        if query.query_dict is not None:
+            info["shape"] = query.shape_key
+            info["limit"] = query._limit
+            info["backref_limit"] = query.backref_limit
+        if self.high_water_mark is not None:
+            info["incremental"] = query.incremental_column.name
+            info["high_water_mark"] = encode_high_water_mark(self.high_water_mark)
+        backend = query.cache_backend
+        backend.put(query.cache_name, self._temp_file, info)
+        max_size = query.session.db.cache_max_size
+        if max_size is not None:
+            # Least recently used entries first, but never the new one
+            self.evicted = backend.evict(
+                max_size * 1024 * 1024, keep=[query.cache_name]
+            )
+
+
 class QueryProperty(object):
     def __init__(self, db):
         self.db = db
@@ -264,6 +762,92 @@ class QueryProperty(object):
             return self
 
 
+def iter_cache_chunks(reader, cache_file):
+    try:
+        yield from reader
+    finally:
+        cache_file.close()
+
+
+def limit_backref_collections(objects, backref_limit):
+    """Keeps the ``backref_limit`` first related objects of the collections
+    of ``objects`` and of their related objects, like the "selectin" loader
+    queries do: the limit applies to the children of each chunk of parents,
+    in the default ordering of the children (descending primary key).
+    """
+    seen = set()
+    level = list(objects)
+    while level:
+        next_level = []
+        for parents in chunks(level, SelectInLoader._chunksize):
+            collections = {}
+            for parent in parents:
+                state = inspect(parent)
+                for relationship in state.mapper.relationships:
+                    value = state.dict.get(relationship.key)
+                    if value is None:
+                        continue
+                    if not relationship.uselist:
+                        next_level.append(value)
+                        continue
+                    parents_, children = collections.setdefault(
+                        relationship, ([], {})
+                    )
+                    parents_.append(parent)
+                    children.update((id(child), child) for child in value)
+
+            for relationship, (parents_, children) in collections.items():
+                mapper = relationship.mapper
+                children = sorted(
+                    children.values(),
+                    key=lambda child: mapper.primary_key_from_instance(child),
+                    reverse=True,
+                )[:backref_limit]
+                kept = set(id(child) for child in children)
+                for parent in parents_:
+                    value = instance_dict(parent)[relationship.key]
+                    value = [child for child in value if id(child) in kept]
+                    set_committed_value(parent, relationship.key, value)
+                next_level.extend(children)
+
+        level = []
+        for obj in next_level:
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                level.append(obj)
+    return objects
+
+
+def encode_high_water_mark(value):
+    """Encodes the high-water mark of any column type in the cache info."""
+    return base64.b64encode(pickle.dumps(value)).decode("ascii")
+
+
+def decode_high_water_mark(data):
+    return pickle.loads(base64.b64decode(data))
+
+
+def make_transient_all(session):
+    """Makes all the ``session`` instances transient in a single pass."""
+    # The identity map is emptied in place rather than replaced, since a
+    # streamed query keeps loading its next batches into the same map
+    for instance in list(session):
+        make_transient(instance)
+
+
+def keyset_criterion(columns, values):
+    """Returns the criterion selecting the rows after ``values`` in the
+    descending ordering of ``columns`` (the default primary key ordering).
+    The row values comparison is expanded so that every dialect supports it.
+    """
+    return or_(
+        *[
+            and_(*[c == v for c, v in zip(columns[:i], values)], columns[i] < values[i])
+            for i in range(len(columns))
+        ]
+    )
+
+
 def render_query(query, reindent=True):
     """Generate an SQL expression string with bound parameters rendered inline
     for the given SQLAlchemy statement.
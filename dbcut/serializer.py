@@ -72,6 +72,20 @@ def dump_json(data, filepath):
         fd.write(to_json(data))
 
 
+def dump_json_list(iterable, filepath):
+    """Serialize the items of ``iterable`` as a JSON array to ``filepath``
+    without building the whole list in memory."""
+    encoder_cls = new_json_encoder()
+    with open(filepath, "w", encoding="utf-8") as fd:
+        fd.write("[")
+        empty = True
+        for item in iterable:
+            fd.write("\n  " if empty else ",\n  ")
+            fd.write(to_json(item, cls=encoder_cls).replace("\n", "\n  "))
+            empty = False
+        fd.write("]" if empty else "\n]")
+
+
 def load_json(filepath):
     """Deserialize ``filepath`` to a Python object."""
     with open(filepath, "r", encoding="utf-8") as fd:
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import threading
+
 from sqlalchemy.orm import Session, scoped_session, sessionmaker
 
 from .utils import merge_dicts
@@ -20,6 +22,7 @@ class BaseSession(Session):
 class SessionProperty(object):
 
     _scoped_sessions = {}
+    _lock = threading.Lock()
 
     def __init__(self, db=None):
         self.db = db
@@ -37,8 +40,9 @@ class SessionProperty(object):
             obj = self.db
         if obj is not None:
 
-            if obj not in self._scoped_sessions:
-                self._scoped_sessions[obj] = self._create_scoped_session(obj)
+            with self._lock:
+                if obj not in self._scoped_sessions:
+                    self._scoped_sessions[obj] = self._create_scoped_session(obj)
 
             scoped_session = self._scoped_sessions[obj]
 
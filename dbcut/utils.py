@@ -2,10 +2,14 @@
 # coding: utf8
 import os
 import pickle
+import queue
 import sys
+import tempfile
+import threading
 from collections import OrderedDict
 from contextlib import contextmanager
 from io import BytesIO, StringIO
+from itertools import islice
 from string import Template
 
 from pptree import print_tree
@@ -168,12 +172,148 @@ def aslist(generator):
     return wrapper
 
 
+def chunks(iterable, size):
+    """Split ``iterable`` into lists of at most ``size`` items.
+
+    Examples::
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(chunks(range(3), 0))
+    [[0, 1, 2]]
+    """
+    iterator = iter(iterable)
+    size = size or None
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BackgroundIterator(object):
+    """Consumes ``iterable`` from a background thread and hands its items over
+    through a queue bounded to ``maxsize`` items, so that producing the next
+    items overlaps with processing the current ones.
+
+    Examples::
+
+    >>> iterator = BackgroundIterator(range(5), maxsize=2)
+    >>> list(iterator)
+    [0, 1, 2, 3, 4]
+    >>> iterator.high_water_mark <= 2
+    True
+    """
+
+    _done = object()
+
+    def __init__(self, iterable, maxsize):
+        self.iterables = [iterable]
+        self.maxsize = maxsize
+        self.high_water_mark = 0
+        self._queue = queue.Queue(maxsize)
+        self._stopped = threading.Event()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            self.high_water_mark = max(self.high_water_mark, self._queue.qsize())
+            return True
+        return False
+
+    def _produce(self, iterable):
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((self._done, None))
+        except BaseException as exc_value:
+            self._put((self._done, exc_value))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    def __iter__(self):
+        threads = [
+            threading.Thread(target=self._produce, args=(iterable,), daemon=True)
+            for iterable in self.iterables
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            yield from self._consume(len(threads))
+        finally:
+            for thread in threads:
+                thread.join()
+
+    def _consume(self, running):
+        try:
+            while running:
+                item, exc_value = self._queue.get()
+                if item is self._done:
+                    if exc_value is not None:
+                        raise exc_value
+                    running -= 1
+                    continue
+                yield item
+        finally:
+            self._stopped.set()
+
+
+class ParallelIterator(BackgroundIterator):
+    """Consumes each of ``iterables`` from its own background thread and
+    merges their items, in the order they are produced, through a queue
+    bounded to ``maxsize`` items.
+
+    Examples::
+
+    >>> sorted(ParallelIterator([range(3), range(10, 12)], maxsize=2))
+    [0, 1, 2, 10, 11]
+    """
+
+    def __init__(self, iterables, maxsize):
+        super(ParallelIterator, self).__init__(None, maxsize)
+        self.iterables = list(iterables)
+
+
+class QueueIterator(BackgroundIterator):
+    """Hands over the items of the iterable consumed by ``produce``, from a
+    thread of the caller such as an executor worker, through a queue bounded
+    to ``maxsize`` items. ``produce`` returns early once the iterator is
+    closed or ``stop`` is called.
+
+    Examples::
+
+    >>> iterator = QueueIterator(maxsize=5)
+    >>> iterator.produce(range(3))
+    >>> list(iterator)
+    [0, 1, 2]
+    """
+
+    def __init__(self, maxsize):
+        super(QueueIterator, self).__init__(None, maxsize)
+        self.iterables = []
+
+    def produce(self, iterable):
+        self._produce(iterable)
+
+    def stop(self):
+        self._stopped.set()
+
+    def __iter__(self):
+        return self._consume(1)
+
+
 def create_directory(dir_path):
     absolute_dir_path = os.path.realpath(
         os.path.join(os.getcwd(), os.path.expanduser(dir_path))
     )
-    if not os.path.exists(absolute_dir_path):
-        os.makedirs(absolute_dir_path)
+    os.makedirs(absolute_dir_path, exist_ok=True)
     return absolute_dir_path
 
 
@@ -250,13 +390,34 @@ def monkeypatched(owner, attr, value):
         setattr(owner, attr, old)
 
 
-def get_directory_size(directory):
-    """" Get directory disk usage in MB"""
-    directory_size = 0
-    for (path, dirs, files) in os.walk(directory):
-        for file in files:
-            directory_size += os.path.getsize(os.path.join(path, file))
-    return directory_size / (1024 * 1024.0)
+@contextmanager
+def atomic_path(path):
+    """Yields a temporary path in the directory of ``path``, renamed to
+    ``path`` at the end of the block (and removed on errors)."""
+    directory, basename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix=basename + ".", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        yield temp_path
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+
+
+def get_peak_memory():
+    """Get the peak resident memory of the process in MB (None if unknown)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024.0)
+    return peak / 1024.0
 
 
 def expand_env_variables(content):
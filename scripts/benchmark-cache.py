@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Compare the size and the read throughput of the cache formats: the legacy
+pickles of ORM objects and the compressed rows.
+
+  $ python scripts/benchmark-cache.py --rows 100000
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy.orm import joinedload
+
+from dbcut.cache import CACHE_CODECS, CacheReader, CacheWriter
+from dbcut.database import Database
+from dbcut.utils import chunks
+
+
+def create_source_database(path, rows):
+    con = sqlite3.connect(path)
+    con.executescript(
+        """
+        CREATE TABLE artist (id INTEGER PRIMARY KEY, name VARCHAR(50));
+        CREATE TABLE album (
+            id INTEGER PRIMARY KEY,
+            title VARCHAR(50),
+            artist_id INTEGER REFERENCES artist(id)
+        );
+        """
+    )
+    artists = max(rows // 10, 1)
+    con.executemany(
+        "INSERT INTO artist VALUES (?, ?)",
+        ((i, "artist %d" % i) for i in range(1, artists + 1)),
+    )
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)",
+        ((i, "album %d" % i, i % artists + 1) for i in range(1, rows + 1)),
+    )
+    con.commit()
+    con.close()
+
+
+def write_legacy(path, groups):
+    with open(path, "wb") as fd:
+        for group in groups:
+            fd.write(sa_serializer.dumps(group))
+
+
+def read_legacy(path, db):
+    count = 0
+    with open(path, "rb") as fd:
+        while True:
+            try:
+                unpickler = sa_serializer.Deserializer(fd, db.metadata, db.session)
+                count += len(unpickler.load())
+            except EOFError:
+                break
+    return count
+
+
+def write_rows(path, groups, db, codec):
+    with open(path, "wb") as fd:
+        writer = CacheWriter(fd, db, codec=codec)
+        for group in groups:
+            writer.write(group)
+        writer.close()
+
+
+def read_rows(path):
+    count = 0
+    with open(path, "rb") as fd:
+        for chunk in CacheReader(fd):
+            chunk.rows_by_table()
+            count += len(chunk)
+    return count
+
+
+def run_benchmark(rows, batch_size):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source.db")
+        create_source_database(source, rows)
+        db = Database(uri="sqlite:///%s" % source, enable_cache=False)
+        db.reflect()
+        album = db.models["album"]
+        objects = list(db.query(album).options(joinedload(album.artist)).objects())
+        groups = list(chunks(objects, batch_size))
+
+        formats = [
+            (
+                "legacy",
+                lambda path: write_legacy(path, groups),
+                lambda path: read_legacy(path, db),
+            )
+        ]
+        for codec in CACHE_CODECS:
+            formats.append(
+                (
+                    "rows-%s" % codec,
+                    lambda path, codec=codec: write_rows(path, groups, db, codec),
+                    read_rows,
+                )
+            )
+        for name, write, read in formats:
+            path = os.path.join(tmpdir, "%s.cache" % name)
+            write(path)
+            start = time.time()
+            count = read(path)
+            duration = time.time() - start
+            db.session.remove()
+            print(
+                "%-10s %10d bytes  %8.2fs  %10d objects/s"
+                % (name, os.path.getsize(path), duration, count / duration)
+            )
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    run_benchmark(args.rows, args.batch_size)
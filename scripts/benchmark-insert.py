@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Compare the insert modes on a synthetic SQLite source database.
+
+  $ python scripts/benchmark-insert.py --rows 100000
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from click.testing import CliRunner
+
+from dbcut.cli.main import main
+from dbcut.loaders import INSERT_MODES
+
+CONFIG = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: no
+queries:
+  - from: track
+    limit: no
+    backref_depth: 0
+    join_depth: 2
+"""
+
+
+def create_source_database(path, rows):
+    con = sqlite3.connect(path)
+    con.executescript(
+        """
+        CREATE TABLE artist (id INTEGER PRIMARY KEY, name VARCHAR(50));
+        CREATE TABLE album (
+            id INTEGER PRIMARY KEY,
+            title VARCHAR(50),
+            artist_id INTEGER REFERENCES artist(id)
+        );
+        CREATE TABLE track (
+            id INTEGER PRIMARY KEY,
+            name VARCHAR(50),
+            album_id INTEGER REFERENCES album(id)
+        );
+        """
+    )
+    albums = max(rows // 10, 1)
+    artists = max(albums // 10, 1)
+    con.executemany(
+        "INSERT INTO artist VALUES (?, ?)",
+        ((i, "artist %d" % i) for i in range(1, artists + 1)),
+    )
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)",
+        ((i, "album %d" % i, i % artists + 1) for i in range(1, albums + 1)),
+    )
+    con.executemany(
+        "INSERT INTO track VALUES (?, ?, ?)",
+        ((i, "track %d" % i, i % albums + 1) for i in range(1, rows + 1)),
+    )
+    con.commit()
+    con.close()
+
+
+def run_benchmark(rows, insert_modes, extra_args):
+    runner = CliRunner()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source.db")
+        create_source_database(source, rows)
+        for insert_mode in insert_modes:
+            destination = os.path.join(tmpdir, "%s.db" % insert_mode)
+            config = os.path.join(tmpdir, "%s.yml" % insert_mode)
+            with open(config, "w") as fd:
+                fd.write(CONFIG.format(source=source, destination=destination))
+            args = ["-y", "--quiet", "-c", config, "load", "--insert-mode"]
+            start = time.time()
+            result = runner.invoke(main, args + [insert_mode] + list(extra_args))
+            duration = time.time() - start
+            if result.exit_code != 0:
+                print(result.output)
+                raise SystemExit(result.exit_code)
+            print("%-6s %8d rows  %8.2fs" % (insert_mode, rows, duration))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument(
+        "--mode", dest="insert_modes", action="append", choices=list(INSERT_MODES)
+    )
+    args, extra_args = parser.parse_known_args()
+    run_benchmark(args.rows, args.insert_modes or list(INSERT_MODES), extra_args)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Measure how detaching the fetched objects from the source session scales
+with the number of objects, on a synthetic SQLite schema.
+
+  $ python scripts/benchmark-transient.py --sizes 1000 10000 100000 1000000
+"""
+
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy.orm import object_session, selectinload
+from sqlalchemy.orm.session import make_transient
+
+from dbcut.database import Database
+
+
+def create_schema(db, size):
+    with db.engine.connect() as con:
+        con.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY, name VARCHAR(50))")
+        con.execute(
+            "CREATE TABLE child (id INTEGER PRIMARY KEY, name VARCHAR(50),"
+            " parent_id INTEGER REFERENCES parent(id))"
+        )
+        parents = max(size // 2, 1)
+        con.execute(
+            "INSERT INTO parent VALUES (?, ?)",
+            [(i, "parent %d" % i) for i in range(1, parents + 1)],
+        )
+        con.execute(
+            "INSERT INTO child VALUES (?, ?, ?)",
+            [(i, "child %d" % i, i) for i in range(1, size - parents + 1)],
+        )
+
+
+def legacy_transient_objects(objects):
+    """The previous implementation, scanning the session for each object."""
+    session = None
+    for obj in objects:
+        if session is None:
+            session = object_session(obj)
+        for instance in session or []:
+            make_transient(instance)
+        yield obj
+
+
+def run_benchmark(size, legacy=False):
+    tmpdir = tempfile.mkdtemp()
+    db = Database(uri="sqlite:///%s/source.db" % tmpdir, enable_cache=False)
+    create_schema(db, size)
+    db.reflect()
+    parent = db.models["parent"]
+    query = db.query(parent).options(selectinload(parent.parent_child_collection))
+    # Only the detachment is measured, the objects are loaded beforehand
+    objects = query.all()
+
+    start = time.time()
+    if legacy:
+        list(legacy_transient_objects(objects))
+    else:
+        list(query.transient_objects(objects))
+    duration = time.time() - start
+    db.close()
+    shutil.rmtree(tmpdir)
+    return duration
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000]
+    )
+    parser.add_argument(
+        "--legacy", action="store_true", help="Also run the previous implementation"
+    )
+    args = parser.parse_args()
+    for size in args.sizes:
+        duration = run_benchmark(size)
+        line = "%8d objects  %8.3fs  %6.2f us/object" % (
+            size,
+            duration,
+            duration * 1e6 / size,
+        )
+        if args.legacy:
+            legacy_duration = run_benchmark(size, legacy=True)
+            line += "  (previous: %8.3fs)" % legacy_duration
+        print(line)
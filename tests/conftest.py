@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+from dbcut.database import Database
+from dbcut.utils import pickle_copy
+
+SCHEMA = """
+CREATE TABLE artist (id INTEGER PRIMARY KEY, name VARCHAR(50));
+CREATE TABLE album (
+    id INTEGER PRIMARY KEY,
+    title VARCHAR(50),
+    artist_id INTEGER REFERENCES artist(id)
+);
+"""
+
+
+@pytest.fixture
+def src_db(tmp_path):
+    path = str(tmp_path / "src.db")
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+    con.executemany(
+        "INSERT INTO artist VALUES (?, ?)", [(i, "artist%d" % i) for i in range(1, 4)]
+    )
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)",
+        [(i, "album%d" % i, (i % 3) + 1) for i in range(1, 10)],
+    )
+    con.commit()
+    con.close()
+    db = Database(uri="sqlite:///%s" % path, enable_cache=False)
+    db.reflect()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def dest_db(tmp_path, src_db):
+    db = Database(
+        uri="sqlite:///%s" % str(tmp_path / "dest.db"),
+        enable_cache=False,
+        metadata=pickle_copy(src_db.metadata),
+    )
+    db.prepare()
+    db.create_all()
+    yield db
+    db.close()
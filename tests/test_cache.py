@@ -0,0 +1,151 @@
+import fcntl
+import os
+import threading
+import time
+from io import BytesIO
+
+import pytest
+from sqlalchemy.orm import joinedload
+
+from dbcut.cache import (
+    CACHE_CODECS,
+    CHUNK_LENGTH,
+    FOOTER,
+    HEADER,
+    CacheLock,
+    CacheManifest,
+    CacheReader,
+    CacheWriter,
+    is_rows_cache,
+)
+from dbcut.exceptions import CorruptedCacheError
+
+
+@pytest.fixture
+def albums(src_db):
+    album = src_db.models["album"]
+    return list(src_db.query(album).options(joinedload(album.artist)).objects())
+
+
+@pytest.mark.parametrize("codec", list(CACHE_CODECS))
+def test_cache_rows(src_db, albums, codec):
+    fd = BytesIO()
+    writer = CacheWriter(fd, src_db, codec=codec)
+    assert writer.write(albums[:5]) == 5
+    assert writer.write(albums[5:]) == 4
+    writer.close()
+
+    fd.seek(0)
+    assert is_rows_cache(fd)
+    reader = CacheReader(fd)
+    reader.verify()
+    chunks = list(reader)
+    assert [len(chunk) for chunk in chunks] == [5, 4]
+    rows_by_table = chunks[0].rows_by_table()
+    assert rows_by_table["album"][0] == {"id": 9, "title": "album9", "artist_id": 1}
+    assert sorted(row["id"] for row in rows_by_table["artist"]) == [1, 2, 3]
+
+
+def test_cache_objects(src_db, albums):
+    fd = BytesIO()
+    writer = CacheWriter(fd, src_db)
+    writer.write(albums)
+    writer.close()
+    fd.seek(0)
+    [chunk] = CacheReader(fd)
+    objects = chunk.to_objects(src_db)
+    assert [obj.id for obj in objects] == [obj.id for obj in albums]
+    assert [obj.artist.name for obj in objects] == [obj.artist.name for obj in albums]
+    assert objects[0].artist is objects[3].artist
+
+
+def test_corrupted_cache(src_db, albums):
+    fd = BytesIO()
+    writer = CacheWriter(fd, src_db)
+    writer.write(albums)
+    writer.close()
+    data = fd.getvalue()
+
+    flipped = bytearray(data)
+    flipped[-10] ^= 0xFF
+    with pytest.raises(CorruptedCacheError):
+        CacheReader(BytesIO(bytes(flipped))).verify()
+    with pytest.raises(CorruptedCacheError):
+        CacheReader(BytesIO(data[:-8])).verify()
+    with pytest.raises(CorruptedCacheError):
+        list(CacheReader(BytesIO(data[:-9])))
+
+
+def test_cache_format_version_1(src_db, albums):
+    fd = BytesIO()
+    writer = CacheWriter(fd, src_db)
+    writer.write(albums[:5])
+    writer.write(albums[5:])
+    writer.close()
+    # No empty chunk nor checksum in the version 1
+    data = bytearray(fd.getvalue()[: -CHUNK_LENGTH.size - FOOTER.size])
+    data[HEADER.size - 2] = 1
+
+    reader = CacheReader(BytesIO(bytes(data)))
+    assert reader.version == 1
+    assert reader.is_outdated
+    reader.verify()
+    assert [len(chunk) for chunk in reader] == [5, 4]
+
+
+def test_cache_lock(tmp_path):
+    lock = CacheLock(str(tmp_path / "entry.lock"))
+    lock.acquire()
+    assert os.path.exists(str(tmp_path / "entry.lock"))
+    lock.release()
+    lock.release()
+
+
+def test_cache_lock_is_shared_by_threads(tmp_path):
+    path = str(tmp_path / "entry.lock")
+
+    def is_locked():
+        with open(path, "a") as fd:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return False
+
+    lock = CacheLock(path)
+    lock.acquire()
+    other_lock = CacheLock(path)
+    thread = threading.Thread(target=other_lock.acquire, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    lock.release()
+    assert is_locked()
+    other_lock.release()
+    assert not is_locked()
+
+
+def test_legacy_cache_is_detected():
+    assert not is_rows_cache(BytesIO(b"\x80\x04\x95"))
+
+
+def test_cache_manifest(tmp_path, monkeypatch):
+    manifest = CacheManifest(str(tmp_path))
+    clock = iter(range(100))
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    for key, size in (("a", 10), ("b", 20), ("c", 30)):
+        basename = str(tmp_path / key)
+        with open(basename + ".cache", "wb") as fd:
+            fd.write(b"x" * size)
+        manifest.add(key, "album", basename)
+    manifest.hit("a", "album", str(tmp_path / "a"))
+    assert manifest.total_size() == 60
+    assert [entry["key"] for entry in manifest.entries()] == ["b", "c", "a"]
+
+    evicted = manifest.evict(35, keep=["b"])
+    assert [entry["key"] for entry in evicted] == ["c"]
+    assert manifest.total_size() == 30
+    evicted = manifest.evict(0, keep=["b"])
+    assert [entry["key"] for entry in evicted] == ["a"]
+    assert sorted(os.listdir(str(tmp_path))) == ["b.cache", "manifest.db"]
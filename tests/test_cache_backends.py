@@ -0,0 +1,147 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from dbcut.cache_backends import (
+    DirectoryCacheBackend,
+    HttpCacheBackend,
+    MemoryCacheBackend,
+    SqliteCacheBackend,
+    get_cache_backend,
+)
+
+NAME = "sqlite/src.db/album-%s" % ("a" * 40)
+
+
+class FakeObjectStore(BaseHTTPRequestHandler):
+    objects = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        data = self.objects.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def do_PUT(self):
+        length = int(self.headers["Content-Length"])
+        self.objects[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_DELETE(self):
+        found = self.objects.pop(self.path, None) is not None
+        self.send_response(204 if found else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def http_url():
+    server = HTTPServer(("127.0.0.1", 0), FakeObjectStore)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d/cache" % server.server_port
+    server.shutdown()
+    server.server_close()
+    FakeObjectStore.objects.clear()
+
+
+@pytest.fixture(params=["directory", "sqlite", "memory", "http"])
+def backend(request, tmp_path):
+    if request.param == "directory":
+        return DirectoryCacheBackend(str(tmp_path / "cache"))
+    if request.param == "sqlite":
+        return SqliteCacheBackend(str(tmp_path / "cache.db"))
+    if request.param == "memory":
+        return MemoryCacheBackend()
+    return HttpCacheBackend(request.getfixturevalue("http_url"))
+
+
+def put_entry(backend, name, data, count):
+    fd, path = backend.mkstemp(name)
+    with open(fd, "wb") as temp_file:
+        temp_file.write(data)
+    backend.put(name, path, {"count": count})
+
+
+def test_backend_entries(backend):
+    assert not backend.exists(NAME)
+    assert backend.info(NAME) is None
+    assert backend.stream(NAME) is None
+
+    put_entry(backend, NAME, b"rows", 4)
+    assert backend.exists(NAME)
+    assert backend.info(NAME) == {"count": 4}
+    assert backend.get(NAME) == b"rows"
+    put_entry(backend, NAME, b"new rows", 8)
+    with backend.stream(NAME) as fd:
+        assert fd.read() == b"new rows"
+    assert backend.info(NAME) == {"count": 8}
+
+    backend.remove(NAME)
+    assert not backend.exists(NAME)
+
+
+def test_backend_move(backend):
+    previous_name = "0.2.0/" + NAME
+    put_entry(backend, previous_name, b"rows", 4)
+    if not isinstance(backend, HttpCacheBackend):
+        assert backend.prefixed_names(NAME) == [previous_name]
+    assert backend.move(previous_name, NAME)
+    assert backend.get(NAME) == b"rows"
+    assert backend.info(NAME) == {"count": 4}
+    assert not backend.exists(previous_name)
+    assert not backend.move(previous_name, NAME)
+
+
+@pytest.mark.parametrize("backend_class", [DirectoryCacheBackend, SqliteCacheBackend])
+def test_backend_eviction(backend_class, tmp_path, monkeypatch):
+    if backend_class is DirectoryCacheBackend:
+        backend = backend_class(str(tmp_path))
+    else:
+        backend = backend_class(str(tmp_path / "cache.db"))
+    clock = iter(range(100))
+    monkeypatch.setattr(time, "time", lambda: next(clock))
+    names = ["db/album-%s" % (key * 40) for key in "abc"]
+    for name, size in zip(names, (10, 20, 30)):
+        put_entry(backend, name, b"x" * size, 1)
+    backend.get(names[0])
+
+    stats = backend.stats()
+    assert [entry["name"] for entry in stats] == names[1:] + names[:1]
+    assert stats[0]["model"] == "album"
+    assert stats[0]["key"] == "b" * 40
+    assert stats[-1]["hits"] == 1
+    assert backend.total_size() >= 60
+
+    evicted = backend.evict(backend.total_size() - 1, keep=[names[1]])
+    assert [entry["name"] for entry in evicted] == [names[2]]
+    backend.clear()
+    assert backend.stats() == []
+    assert not backend.exists(names[0])
+
+
+def test_get_cache_backend(tmp_path):
+    assert isinstance(get_cache_backend(str(tmp_path)), DirectoryCacheBackend)
+    backend = get_cache_backend("sqlite:///%s" % (tmp_path / "cache.db"))
+    assert backend.path == str(tmp_path / "cache.db")
+    assert isinstance(get_cache_backend("memory://"), MemoryCacheBackend)
+    assert isinstance(get_cache_backend("https://cache/dbcut"), HttpCacheBackend)
+    with pytest.raises(ValueError):
+        get_cache_backend("ftp://cache")
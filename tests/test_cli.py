@@ -1,6 +1,15 @@
 #!/usr/bin/env python
+import os
+import shutil
+import sqlite3
+import time
+from itertools import chain
+
+import pytest
 from click.testing import CliRunner
+from sqlalchemy.orm.strategies import SelectInLoader
 
+from dbcut.cli import operations
 from dbcut.cli.main import main
 
 DEFAULT_YML = """
@@ -229,3 +238,356 @@ databases:
         assert not result.exit_code == 0
         print(result.output)
         assert "XXXMYSQL_USER" in result.output
+
+
+def test_purgecache_unreachable(src_db, tmp_path):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+  - from: artist
+  - from: album
+    limit: {limit}
+"""
+    runner = CliRunner()
+
+    def write_config(limit):
+        with open("dbcut.yml", "w") as f:
+            f.write(
+                config.format(
+                    source=src_db.uri.database,
+                    destination=tmp_path / "dest.db",
+                    cache=tmp_path / "cache",
+                    limit=limit,
+                )
+            )
+
+    def list_cache_files():
+        return sorted(
+            name
+            for root, dirs, files in os.walk(str(tmp_path / "cache"))
+            for name in files
+            if name.endswith((".cache", ".count")) and name != "metadata.cache"
+        )
+
+    with runner.isolated_filesystem():
+        write_config(limit=5)
+        do_invoke_test(runner, main, ["-y", "load"])
+        write_config(limit=3)
+        do_invoke_test(runner, main, ["-y", "load"])
+        assert len(list_cache_files()) == 6
+
+        result = runner.invoke(main, ["-y", "purgecache", "--unreachable"])
+        assert "Purged 1 unreachable cache entries" in result.output
+        files = list_cache_files()
+        assert len(files) == 4
+        do_invoke_test(runner, main, ["-y", "load"])
+        assert list_cache_files() == files
+
+
+def test_purgecache_unreachable_of_other_database(src_db, tmp_path):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+  - from: {table}
+"""
+    other_source = str(tmp_path / "other.db")
+    shutil.copy(src_db.uri.database, other_source)
+    runner = CliRunner()
+
+    def load(source, table):
+        with open("dbcut.yml", "w") as f:
+            f.write(
+                config.format(
+                    source=source,
+                    destination=tmp_path / "dest.db",
+                    cache=tmp_path / "cache",
+                    table=table,
+                )
+            )
+        result = runner.invoke(main, ["-y", "load"], catch_exceptions=False)
+        assert result.exit_code == 0
+        return result.output
+
+    with runner.isolated_filesystem():
+        load(other_source, "album")
+        load(src_db.uri.database, "album")
+        load(src_db.uri.database, "artist")
+        result = runner.invoke(main, ["-y", "purgecache", "--unreachable"])
+        assert "Purged 1 unreachable cache entries" in result.output
+        assert "Using cache" in load(other_source, "album")
+
+
+def test_warmcache(src_db, tmp_path):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+  - from: artist
+  - from: album
+""".format(
+        source=src_db.uri.database,
+        destination=tmp_path / "dest.db",
+        cache=tmp_path / "cache",
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        result = runner.invoke(main, ["warmcache", "-j", "2"], catch_exceptions=False)
+        assert result.output.count("fetched") == 4
+        assert not os.path.exists(str(tmp_path / "dest.db"))
+
+        result = runner.invoke(main, ["warmcache"], catch_exceptions=False)
+        assert result.output.count("cached") == 4
+        result = runner.invoke(main, ["-y", "load"], catch_exceptions=False)
+        assert result.output.count("Using cache") == 2
+
+
+@pytest.mark.parametrize("queue_depth", [0, 4])
+@pytest.mark.parametrize("yield_per", [None, 500])
+def test_load_backref_limit(src_db, tmp_path, queue_depth, yield_per):
+    # The artists are loaded by two fetches or two "selectin" chunks, so that
+    # the second one is made by the pipeline thread
+    con = sqlite3.connect(src_db.uri.database)
+    con.executemany(
+        "INSERT INTO artist VALUES (?, ?)",
+        [(i, "artist%d" % i) for i in range(4, 1001)],
+    )
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)",
+        [(i, "album%d" % i, (i % 1000) + 1) for i in range(10, 3001)],
+    )
+    con.commit()
+    con.close()
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+  - from: artist
+    limit: no
+    backref_limit: 2
+    backref_depth: 1
+    yield_per: {yield_per}
+""".format(
+        source=src_db.uri.database,
+        destination=tmp_path / "dest.db",
+        cache=tmp_path / "cache",
+        yield_per=yield_per or "no",
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        for using_cache in (False, True):
+            result = runner.invoke(
+                main,
+                ["-y", "load", "--queue-depth", str(queue_depth)],
+                catch_exceptions=False,
+            )
+            assert result.exit_code == 0
+            assert ("Using cache" in result.output) is using_cache
+            con = sqlite3.connect(str(tmp_path / "dest.db"))
+            try:
+                count = con.execute("SELECT count(*) FROM artist").fetchone()
+                assert count == (1000,)
+                # backref_limit applies to each chunk of 500 artists
+                count = con.execute("SELECT count(*) FROM album").fetchone()
+                assert count == (4,)
+            finally:
+                con.close()
+            do_invoke_test(runner, main, ["-y", "flush"])
+
+
+def test_load_duplicate_queries_concurrently(src_db, tmp_path):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+  - from: album
+  - from: artist
+  - from: album
+  - from: artist
+  - from: album
+""".format(
+        source=src_db.uri.database,
+        destination=tmp_path / "dest.db",
+        cache=tmp_path / "cache",
+    )
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        for _ in range(3):
+            do_invoke_test(runner, main, ["-y", "purgecache"])
+            do_invoke_test(runner, main, ["-y", "load", "-j", "3"])
+        result = runner.invoke(main, ["-y", "load", "-j", "3"], catch_exceptions=False)
+        assert result.output.count("Using cache") == 5
+
+
+def test_deferred_indexes_of_failed_load(src_db, tmp_path, monkeypatch):
+    con = sqlite3.connect(src_db.uri.database)
+    con.execute("CREATE INDEX album_title_idx ON album (title)")
+    con.commit()
+    con.close()
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+queries:
+  - from: album
+""".format(
+        source=src_db.uri.database, destination=tmp_path / "dest.db"
+    )
+
+    def insert_batches(ctx, session, batches):
+        raise RuntimeError("load failed")
+
+    monkeypatch.setattr(operations, "insert_batches", insert_batches)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        result = runner.invoke(main, ["-y", "load", "--no-cache", "--defer-indexes"])
+        assert result.exit_code == 1
+        assert "Error: load failed" in result.output
+        assert "Creating 1 deferred indexes" in result.output
+    con = sqlite3.connect(str(tmp_path / "dest.db"))
+    try:
+        indexes = [row[1] for row in con.execute("PRAGMA index_list(album)")]
+    finally:
+        con.close()
+    assert "album_title_idx" in indexes
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_fetch_messages_are_logged_in_order(src_db, tmp_path, jobs):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+cache: {cache}
+queries:
+{queries}
+"""
+    runner = CliRunner()
+
+    def write_config(*queries):
+        with open("dbcut.yml", "w") as f:
+            f.write(
+                config.format(
+                    source=src_db.uri.database,
+                    destination=tmp_path / "dest.db",
+                    cache=tmp_path / "cache",
+                    queries="\n".join(queries),
+                )
+            )
+
+    with runner.isolated_filesystem():
+        write_config("  - from: album\n    limit: 5\n    backref_limit: no")
+        do_invoke_test(runner, main, ["-y", "load"])
+        write_config(
+            "  - from: artist",
+            "  - from: album\n    limit: 3\n    backref_limit: no",
+            "  - from: artist\n    limit: 2",
+        )
+        result = runner.invoke(
+            main, ["-y", "load", "-j", str(jobs)], catch_exceptions=False
+        )
+        output = result.output
+        message = output.index("Derived from a cached larger result")
+        assert output.index("Query 2/3") < message < output.index("Query 3/3")
+
+
+def test_concurrent_fetch_streams_the_objects(src_db, tmp_path, monkeypatch):
+    con = sqlite3.connect(src_db.uri.database)
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)",
+        [(i, "album%d" % i, (i % 3) + 1) for i in range(10, 51)],
+    )
+    con.commit()
+    con.close()
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+queries:
+  - from: album
+    limit: no
+    yield_per: 1
+    page_size: 1
+""".format(
+        source=src_db.uri.database, destination=tmp_path / "dest.db"
+    )
+    # Each page of one album is fetched by its own statement
+    monkeypatch.setattr(SelectInLoader, "_chunksize", 1)
+    selects = []
+    insert_batches = operations.insert_batches
+
+    def first_batch_insert(ctx, session, batches):
+        batches = iter(batches)
+        first_batch = next(batches)
+        time.sleep(0.2)
+        selects.append(ctx.src_db.statements_counter["SELECT"])
+        inserted = insert_batches(ctx, session, chain([first_batch], batches))
+        selects.append(ctx.src_db.statements_counter["SELECT"])
+        return inserted
+
+    monkeypatch.setattr(operations, "insert_batches", first_batch_insert)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        args = ["-y", "load", "--no-cache", "-j", "2", "--queue-depth", "1"]
+        do_invoke_test(runner, main, args)
+    # Only a few pages are fetched ahead of the insert
+    first_batch_selects, total_selects = selects
+    assert first_batch_selects < total_selects / 2
+    con = sqlite3.connect(str(tmp_path / "dest.db"))
+    try:
+        assert con.execute("SELECT count(*) FROM album").fetchone() == (50,)
+    finally:
+        con.close()
+
+
+def test_concurrent_fetch_of_failed_load(src_db, tmp_path, monkeypatch):
+    config = """
+databases:
+  source_uri: sqlite:///{source}
+  destination_uri: sqlite:///{destination}
+queries:
+  - from: album
+    limit: no
+    yield_per: 1
+    page_size: 1
+  - from: artist
+""".format(
+        source=src_db.uri.database, destination=tmp_path / "dest.db"
+    )
+    monkeypatch.setattr(SelectInLoader, "_chunksize", 1)
+
+    def insert_batches(ctx, session, batches):
+        next(iter(batches))
+        raise RuntimeError("load failed")
+
+    monkeypatch.setattr(operations, "insert_batches", insert_batches)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(config)
+        args = ["-y", "load", "--no-cache", "-j", "2", "--queue-depth", "1"]
+        # The workers blocked on their full queues are stopped
+        result = runner.invoke(main, args)
+        assert result.exit_code == 1
+        assert "Error: load failed" in result.output
@@ -0,0 +1,167 @@
+import os
+import pickle
+import sqlite3
+
+from sqlalchemy import Index, UniqueConstraint, inspect
+
+from dbcut.database import METADATA_FORMAT_VERSION, Database
+from dbcut.utils import pickle_copy
+
+
+def test_sqlite_fast_load(dest_db):
+    with dest_db.sqlite_fast_load():
+        with dest_db.engine.connect() as con:
+            assert con.execute("PRAGMA synchronous").scalar() == 0
+            assert con.execute("PRAGMA journal_mode").scalar() == "off"
+            con.execute("INSERT INTO artist VALUES (1, 'artist1')")
+    with dest_db.engine.connect() as con:
+        assert con.execute("PRAGMA synchronous").scalar() == 2
+        assert con.execute("PRAGMA journal_mode").scalar() == "delete"
+        assert con.execute("SELECT count(*) FROM sqlite_stat1").scalar() > 0
+
+
+def test_create_all_defer_indexes(tmp_path, src_db):
+    metadata = pickle_copy(src_db.metadata)
+    album = metadata.tables["album"]
+    Index("album_title_idx", album.c.title)
+    UniqueConstraint(album.c.artist_id, album.c.title)
+    db = Database(
+        uri="sqlite:///%s" % str(tmp_path / "deferred.db"),
+        enable_cache=False,
+        metadata=metadata,
+    )
+    deferred = db.create_all(defer_indexes=True)
+    assert len(deferred) == 2
+    assert inspect(db.engine).get_indexes("album") == []
+
+    db.create_indexes(deferred)
+    indexes = {i["name"]: i for i in inspect(db.engine).get_indexes("album")}
+    assert indexes.pop("album_title_idx")["column_names"] == ["title"]
+    [unique_index] = indexes.values()
+    assert unique_index["column_names"] == ["artist_id", "title"]
+    assert unique_index["unique"]
+    assert db.create_all(defer_indexes=True) == []
+    db.close()
+
+
+def test_sqlite_in_memory(dest_db):
+    with dest_db.engine.connect() as con:
+        con.execute("INSERT INTO artist VALUES (1, 'artist1')")
+    with dest_db.sqlite_in_memory():
+        with dest_db.engine.connect() as con:
+            assert con.execute("PRAGMA database_list").fetchone()["file"] == ""
+            assert con.execute("SELECT count(*) FROM artist").scalar() == 1
+            con.execute("INSERT INTO artist VALUES (2, 'artist2')")
+        file_connection = sqlite3.connect(dest_db.uri.database)
+        assert file_connection.execute("SELECT count(*) FROM artist").fetchone() == (1,)
+        file_connection.close()
+    with dest_db.engine.connect() as con:
+        assert con.execute("PRAGMA database_list").fetchone()["file"] != ""
+        assert con.execute("SELECT count(*) FROM artist").scalar() == 2
+
+
+def test_estimate_table_sizes(src_db):
+    sizes = {name: (rows, size) for name, rows, size in src_db.estimate_table_sizes()}
+    assert sizes["artist"][0] == 3
+    assert sizes["album"][0] == 9
+    assert sizes["album"][1] > sizes["artist"][1] > 0
+
+
+def test_cached_metadata_of_previous_release(tmp_path, src_db):
+    cache_dir = str(tmp_path / "cache")
+    previous_dir = os.path.join(cache_dir, "0.2.0", src_db.cache_namespace)
+    os.makedirs(previous_dir)
+    with open(os.path.join(previous_dir, "metadata.cache"), "wb") as fd:
+        pickle.dump(src_db.metadata, fd)
+
+    db = Database(uri=str(src_db.uri), cache_dir=cache_dir)
+    assert sorted(db.cached_metadata.tables) == ["album", "artist"]
+    with open(db.cached_metadata_path, "rb") as fd:
+        data = pickle.load(fd)
+    assert data["format_version"] == METADATA_FORMAT_VERSION
+    assert sorted(data["metadata"].tables) == ["album", "artist"]
+    db.reflect()
+    assert sorted(db.tables) == ["album", "artist"]
+    db.close()
+
+
+def test_table_dropped_after_cached_metadata_without_fingerprints(tmp_path, src_db):
+    con = sqlite3.connect(src_db.uri.database)
+    con.execute("CREATE TABLE genre (id INTEGER PRIMARY KEY, name VARCHAR(50))")
+    con.commit()
+    db = Database(uri=str(src_db.uri), enable_cache=False)
+    db.reflect()
+    cache_dir = str(tmp_path / "cache")
+    previous_dir = os.path.join(cache_dir, "0.2.0", src_db.cache_namespace)
+    os.makedirs(previous_dir)
+    with open(os.path.join(previous_dir, "metadata.cache"), "wb") as fd:
+        pickle.dump(db.metadata, fd)
+    db.close()
+    con.execute("DROP TABLE genre")
+    con.commit()
+    con.close()
+
+    db = Database(uri=str(src_db.uri), cache_dir=cache_dir)
+    assert sorted(db.cached_metadata.tables) == ["album", "artist", "genre"]
+    db.reflect()
+    assert sorted(db.tables) == ["album", "artist"]
+    assert sorted(db.load_cached_metadata()["metadata"].tables) == ["album", "artist"]
+    db.close()
+
+
+def test_cached_metadata_fingerprints(tmp_path, src_db):
+    cache_dir = str(tmp_path / "cache")
+    db = Database(uri=str(src_db.uri), cache_dir=cache_dir)
+    db.reflect()
+    fingerprints = db.schema_fingerprints()
+    assert sorted(fingerprints) == ["album", "artist"]
+    assert db.load_cached_metadata()["fingerprints"] == fingerprints
+    db.close()
+
+    con = sqlite3.connect(src_db.uri.database)
+    con.execute("ALTER TABLE album ADD COLUMN year INTEGER")
+    con.execute("CREATE TABLE genre (id INTEGER PRIMARY KEY, name VARCHAR(50))")
+    con.commit()
+    con.close()
+
+    db = Database(uri=str(src_db.uri), cache_dir=cache_dir)
+    assert db.get_stale_tables(fingerprints, db.schema_fingerprints()) == {
+        "album",
+        "genre",
+    }
+    assert db.get_stale_tables(fingerprints, dict(fingerprints, artist="")) == {
+        "album",
+        "artist",
+    }
+    db.reflect()
+    assert sorted(db.tables) == ["album", "artist", "genre"]
+    assert "year" in db.tables["album"].columns
+    assert db.tables["album"].c.artist_id.references(db.tables["artist"].c.id)
+    assert db.load_cached_metadata()["fingerprints"] == db.schema_fingerprints()
+    db.close()
+
+
+def test_partial_reflection(tmp_path, src_db):
+    cache_dir = str(tmp_path / "cache")
+
+    def reflect(reachable_from):
+        db = Database(
+            uri=str(src_db.uri), cache_dir=cache_dir, reachable_from=reachable_from
+        )
+        db.reflect()
+        db.close()
+        return db
+
+    db = reflect([("album", 0, 0, [])])
+    assert sorted(db.tables) == ["album"]
+    assert not db.tables["album"].foreign_keys
+    assert db.load_cached_metadata()["partial"]
+
+    db = reflect([("album", 1, 0, [])])
+    assert sorted(db.tables) == ["album", "artist"]
+    assert db.tables["album"].c.artist_id.references(db.tables["artist"].c.id)
+    assert "artist" in db.models["album"].__mapper__.relationships
+
+    assert sorted(reflect([("artist", 0, 1, [])]).tables) == ["album", "artist"]
+    assert sorted(reflect([("artist", 0, 1, ["album"])]).tables) == ["artist"]
+    assert sorted(reflect(None).tables) == ["album", "artist"]
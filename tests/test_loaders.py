@@ -0,0 +1,120 @@
+import sqlite3
+from io import BytesIO, StringIO
+
+import pytest
+from sqlalchemy.orm import joinedload
+
+from dbcut.bulk import dump_csv, dump_mysql_infile, get_bind_processors
+from dbcut.database import Database
+from dbcut.loaders import INSERT_MODES, extract_rows, get_loader
+from dbcut.utils import pickle_copy
+
+
+def fetch_albums_with_artist(db):
+    album = db.models["album"]
+    return list(db.query(album).options(joinedload(album.artist)).objects())
+
+
+def test_extract_rows_follows_loaded_relationships(src_db):
+    rows = extract_rows(fetch_albums_with_artist(src_db))
+    assert len(rows["album"]) == 9
+    assert sorted(row["id"] for row in rows["artist"]) == [1, 2, 3]
+    assert {"id", "title", "artist_id"} == set(rows["album"][0])
+
+
+def test_extract_rows_skips_already_seen_rows(src_db):
+    seen = set()
+    objects = fetch_albums_with_artist(src_db)
+    first = extract_rows(objects[:5], seen=seen)
+    second = extract_rows(objects[5:], seen=seen)
+    artists = [row["id"] for row in first["artist"] + second.get("artist", [])]
+    assert sorted(artists) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("insert_mode", ["orm", "bulk", "native"])
+def test_loaders_insert_all_rows(src_db, dest_db, insert_mode):
+    with dest_db.no_fkc_session() as session:
+        loader = get_loader(insert_mode, session)
+        assert isinstance(loader, INSERT_MODES[insert_mode])
+        loader.load(fetch_albums_with_artist(src_db))
+    with dest_db.engine.connect() as con:
+        assert con.execute("SELECT count(*) FROM album").scalar() == 9
+        assert con.execute("SELECT count(*) FROM artist").scalar() == 3
+        assert (
+            con.execute("SELECT artist_id FROM album WHERE id = 4").scalar()
+            == (4 % 3) + 1
+        )
+
+
+def test_unknown_insert_mode():
+    with pytest.raises(ValueError):
+        get_loader("fast", None)
+
+
+@pytest.mark.parametrize("insert_mode", ["orm", "bulk", "native"])
+def test_loaders_do_not_emit_updates(src_db, dest_db, insert_mode):
+    dest_db.statements_counter.clear()
+    with dest_db.no_fkc_session() as session:
+        get_loader(insert_mode, session).load(fetch_albums_with_artist(src_db))
+    assert dest_db.statements_counter["UPDATE"] == 0
+    assert dest_db.statements_counter["INSERT"] == 2
+
+
+def test_native_loader_skips_existing_rows(src_db, dest_db):
+    with dest_db.no_fkc_session() as session:
+        get_loader("native", session).load(fetch_albums_with_artist(src_db))
+    with dest_db.no_fkc_session() as session:
+        loader = get_loader("native", session)
+        loader.load(fetch_albums_with_artist(src_db))
+        assert loader.inserted == 12
+    with dest_db.engine.connect() as con:
+        assert con.execute("SELECT count(*) FROM album").scalar() == 9
+        assert con.execute("SELECT count(*) FROM artist").scalar() == 3
+
+
+def test_native_loader_processes_values_as_orm(tmp_path):
+    path = str(tmp_path / "events.db")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE event (id INTEGER PRIMARY KEY, created DATETIME)")
+    con.execute("INSERT INTO event VALUES (1, '2020-01-01 10:00:00')")
+    con.commit()
+    con.close()
+    src_db = Database(uri="sqlite:///%s" % path, enable_cache=False)
+    src_db.reflect()
+    event = src_db.models["event"]
+
+    def stored_value(insert_mode):
+        dest_db = Database(
+            uri="sqlite:///%s" % str(tmp_path / ("%s.db" % insert_mode)),
+            enable_cache=False,
+            metadata=pickle_copy(src_db.metadata),
+        )
+        dest_db.prepare()
+        dest_db.create_all()
+        with dest_db.no_fkc_session() as session:
+            get_loader(insert_mode, session).load(list(src_db.query(event).objects()))
+        with dest_db.engine.connect() as con:
+            value = con.execute("SELECT created FROM event").scalar()
+        dest_db.close()
+        return value
+
+    assert stored_value("native") == stored_value("orm")
+    src_db.close()
+
+    table = src_db.metadata.tables["event"]
+    processors = get_bind_processors(src_db.engine.dialect, table)
+    assert processors[1] is not None
+    assert get_bind_processors(src_db.engine.dialect, table) is processors
+
+
+def test_dump_csv():
+    stream = StringIO()
+    rows = [{"a": 1, "b": None, "c": ""}, {"a": 2, "b": b"ab", "c": 'x"y'}]
+    dump_csv(rows, ["a", "b", "c"], stream)
+    assert stream.getvalue() == '"1",,""\n"2","\\x6162","x""y"\n'
+
+
+def test_dump_mysql_infile():
+    stream = BytesIO()
+    dump_mysql_infile([{"a": 1, "b": None, "c": "x\ty"}], ["a", "b", "c"], stream)
+    assert stream.getvalue() == b"1\t\\N\tx\\ty\n"
@@ -0,0 +1,222 @@
+import sqlite3
+from io import BytesIO
+
+import pytest
+from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy.orm import joinedload, object_session, selectinload
+from sqlalchemy.orm.strategies import SelectInLoader
+
+from dbcut import generated_models
+from dbcut.cache import CHUNK_LENGTH, FOOTER, HEADER, CacheReader, is_rows_cache
+from dbcut.cache_backends import DirectoryCacheBackend
+from dbcut.query import keyset_criterion
+from dbcut.utils import BackgroundIterator, chunks
+
+
+@pytest.fixture
+def album_query(src_db):
+    album = src_db.models["album"]
+    query = src_db.query(album).options(joinedload(album.artist))
+    return query.order_by(*album._default_ordering)
+
+
+def test_streamed_objects_are_transient(album_query):
+    objects = list(album_query.yield_per(2).objects())
+    assert len(objects) == 9
+    assert all(object_session(obj) is None for obj in objects)
+    assert all(object_session(obj.artist) is None for obj in objects)
+
+
+def test_keyset_objects(src_db, album_query, monkeypatch):
+    monkeypatch.setattr(SelectInLoader, "_chunksize", 2)
+    album_query.fetch_options = {"yield_per": None, "page_size": 3}
+    assert album_query.page_size == 4
+    src_db.statements_counter.clear()
+    objects = list(album_query.objects())
+    assert src_db.statements_counter["SELECT"] == 3
+    assert [obj.id for obj in objects] == list(range(9, 0, -1))
+    assert all(object_session(obj) is None for obj in objects)
+    assert [obj.artist.id for obj in objects] == [(i % 3) + 1 for i in range(9, 0, -1)]
+
+
+def test_limited_query_is_not_paginated(album_query):
+    album_query.fetch_options = {"page_size": 3}
+    assert album_query.limit(5).page_size is None
+
+
+def test_shard_ranges(album_query):
+    album_query.fetch_options = {"shards": 4}
+    assert album_query.shard_ranges() == [(7, 9), (5, 6), (3, 4), (1, 2)]
+    album_query.fetch_options = {"shards": "auto"}
+    assert album_query.shard_ranges() == []
+    album_query.fetch_options = {"shards": 4}
+    assert album_query.limit(5).shard_ranges() == []
+
+
+def test_sharded_objects(album_query):
+    album_query.fetch_options = {"shards": 3}
+    objects = list(album_query.objects())
+    assert sorted(obj.id for obj in objects) == list(range(1, 10))
+    assert all(object_session(obj) is None for obj in objects)
+    assert all(obj.artist.id == (obj.id % 3) + 1 for obj in objects)
+
+
+@pytest.mark.parametrize(
+    "fetch_options, albums",
+    [({}, 2), ({"yield_per": 2}, 2), ({"page_size": 2}, 2), ({"shards": 3}, 3)],
+)
+def test_background_backref_limit(src_db, monkeypatch, fetch_options, albums):
+    # backref_limit applies to each "selectin" chunk of 2 artists, even when
+    # the objects are fetched by the pipeline thread
+    monkeypatch.setattr(SelectInLoader, "_chunksize", 2)
+    artist = src_db.models["artist"]
+    query = src_db.query(artist)
+    query.query_dict = {"from": "artist", "backref_limit": 1}
+    query = query.with_loaded_relations(0, 1, [], [])
+    query = query.order_by(*artist._default_ordering)
+    query.fetch_options = fetch_options
+    objects = [
+        obj for group in BackgroundIterator(query.object_groups(), 1) for obj in group
+    ]
+    assert sorted(obj.id for obj in objects) == [1, 2, 3]
+    assert sum(len(obj.artist_album_collection) for obj in objects) == albums
+
+
+def test_keyset_criterion(src_db):
+    album = src_db.models["album"]
+    columns = [album.__table__.c.id, album.__table__.c.artist_id]
+    criterion = str(keyset_criterion(columns, [4, 2]))
+    assert criterion == (
+        "album.id < :id_1 OR album.id = :id_2 AND album.artist_id < :artist_id_1"
+    )
+
+
+@pytest.fixture
+def cached_album_query(src_db, album_query, tmp_path):
+    src_db._cache_backend = DirectoryCacheBackend(str(tmp_path))
+    album_query.query_dict = {"from": "album"}
+    return album_query
+
+
+def test_load_from_cache_streams_chunks(cached_album_query):
+    objects = list(cached_album_query.objects())
+    with cached_album_query.cache_writer() as writer:
+        for batch in chunks(objects, 4):
+            writer.write(batch)
+    assert cached_album_query.is_cached
+
+    count, cached_chunks = cached_album_query.load_from_cache()
+    assert count == 9
+    assert next(cached_chunks).rows_by_table()["album"][0]["id"] == 9
+    assert [len(chunk) for chunk in cached_chunks] == [4, 1]
+
+
+def test_load_from_previous_release_cache(src_db, cached_album_query, tmp_path):
+    with cached_album_query.cache_writer() as writer:
+        writer.write(list(cached_album_query.objects()))
+    backend = src_db.cache_backend
+    name = cached_album_query.cache_name
+    data = bytearray(backend.get(name)[: -CHUNK_LENGTH.size - FOOTER.size])
+    data[HEADER.size - 2] = 1
+    backend.remove(name)
+    version_1_file = str(tmp_path / "version_1.cache")
+    with open(version_1_file, "wb") as fd:
+        fd.write(data)
+    backend.put("0.2.0/" + name, version_1_file, {"count": 9})
+
+    assert cached_album_query.is_cached
+    assert not backend.exists("0.2.0/" + name)
+    count, cached_chunks = cached_album_query.load_from_cache()
+    assert count == 9
+    assert [len(chunk) for chunk in cached_chunks] == [9]
+    with backend.stream(name) as fd:
+        reader = CacheReader(fd)
+        assert not reader.is_outdated
+        reader.verify()
+
+
+def test_load_from_legacy_cache(src_db, cached_album_query, tmp_path, monkeypatch):
+    # The legacy pickles refer to the first generated model of each name
+    for name, model in src_db.models.items():
+        monkeypatch.setitem(generated_models.__all_models__, name, model)
+    objects = list(cached_album_query.objects())
+    legacy_file = str(tmp_path / "legacy.cache")
+    with open(legacy_file, "wb") as fd:
+        for batch in chunks(objects, 4):
+            fd.write(sa_serializer.dumps(batch))
+    backend = src_db.cache_backend
+    backend.put(cached_album_query.cache_name, legacy_file, {"count": 9})
+
+    count, cached_chunks = cached_album_query.load_from_cache()
+    assert count == 9
+    assert [len(chunk) for chunk in cached_chunks] == [4, 4, 1]
+    assert is_rows_cache(BytesIO(backend.get(cached_album_query.cache_name)))
+
+
+def test_incremental_refresh(src_db, cached_album_query):
+    query = cached_album_query.limit(5)
+    query.fetch_options = {"incremental": "id"}
+    assert query.incremental_merge_order() == "first"
+    with query.cache_writer() as writer:
+        writer.write(list(query.objects()))
+    assert writer.high_water_mark == 9
+
+    con = sqlite3.connect(src_db.uri.database)
+    con.executemany(
+        "INSERT INTO album VALUES (?, ?, ?)", [(10, "album10", 1), (11, "album11", 2)]
+    )
+    con.commit()
+    con.close()
+
+    count, groups = query.refreshed_groups()
+    assert count == 5
+    objects = [obj for group in groups for obj in group]
+    assert [obj.id for obj in objects] == [11, 10, 9, 8, 7]
+    assert [obj.artist.name for obj in objects[:2]] == ["artist2", "artist1"]
+
+    album = src_db.models["album"]
+    title_query = cached_album_query.order_by(None).order_by(album.title).limit(5)
+    title_query.fetch_options = {"incremental": "id"}
+    assert title_query.incremental_merge_order() is None
+
+
+def test_subsumed_groups(src_db, tmp_path):
+    src_db._cache_backend = DirectoryCacheBackend(str(tmp_path))
+    artist = src_db.models["artist"]
+
+    def artist_query(limit, backref_limit):
+        query = src_db.query(artist)
+        query.query_dict = {
+            "from": "artist",
+            "limit": limit,
+            "backref_limit": backref_limit,
+        }
+        query = query.options(selectinload("artist_album_collection"))
+        return query.order_by(*artist._default_ordering).limit(limit)
+
+    query = artist_query(3, None)
+    assert query.subsumed_groups() is None
+    with query.cache_writer() as writer:
+        writer.write(list(query.objects()))
+
+    def albums(objects):
+        return [[album.id for album in obj.artist_album_collection] for obj in objects]
+
+    expected_albums = {1: [[8], []], 3: [[8, 5], [7]], None: [[8, 5, 2], [7, 4, 1]]}
+    for backref_limit, expected in expected_albums.items():
+        query = artist_query(2, backref_limit)
+        assert query.shape_key == artist_query(3, None).shape_key
+        assert query.find_superset_entry()[0] == artist_query(3, None).cache_name
+        count, groups = query.subsumed_groups()
+        assert count == 2
+        objects = [obj for group in groups for obj in group]
+        assert [obj.id for obj in objects] == [3, 2]
+        assert albums(objects) == expected
+
+    query = artist_query(3, 3)
+    with query.cache_writer() as writer:
+        writer.write(list(query.objects()))
+    assert artist_query(3, 1).find_superset_entry() is not None
+    name, info = artist_query(2, 1).find_superset_entry()
+    assert name == artist_query(3, None).cache_name
+    assert artist_query(4, None).find_superset_entry() is None
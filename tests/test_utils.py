@@ -1,7 +1,10 @@
+import threading
 import unittest
 from collections import OrderedDict
 
-from dbcut.utils import sorted_nested_dict
+import pytest
+
+from dbcut.utils import BackgroundIterator, QueueIterator, sorted_nested_dict
 
 
 def test_simple_dict_is_sorted():
@@ -56,3 +59,40 @@ def test_non_dicts_are_untouched():
 
     data = Custom()
     assert data is sorted_nested_dict(data)
+
+
+def test_background_iterator_reraises_producer_errors():
+    def failing_generator():
+        yield 1
+        raise ValueError("boom")
+
+    iterator = iter(BackgroundIterator(failing_generator(), maxsize=1))
+    assert next(iterator) == 1
+    with pytest.raises(ValueError):
+        next(iterator)
+
+
+def test_background_iterator_stops_producer_on_close():
+    closed = []
+
+    def infinite_generator():
+        try:
+            while True:
+                yield 1
+        finally:
+            closed.append(True)
+
+    iterator = iter(BackgroundIterator(infinite_generator(), maxsize=2))
+    assert next(iterator) == 1
+    iterator.close()
+    assert closed == [True]
+
+
+def test_queue_iterator_stops_producer():
+    iterator = QueueIterator(maxsize=1)
+    producer = threading.Thread(target=iterator.produce, args=(range(10),))
+    producer.start()
+    assert next(iter(iterator)) == 0
+    iterator.stop()
+    producer.join(5)
+    assert not producer.is_alive()